@@ -1,5 +1,11 @@
 import binascii
+import collections
+import copy
+import hashlib
+import os
+import pickle
 import utils
+import timing
 import re
 
 
@@ -102,14 +108,17 @@ class Tokenizer:
     ]))
 
     def __init__(self, code):
+        # Tokens are kept in a list and consumed by moving an index, popping from the front of a list is O(n).
         self.__tokens = []
+        self.__pos = 0
+        self.__last = None
+        self.__lines = code.split("\n")
         line_num = 1
         for mo in self.TOKEN_REGEX.finditer(code):
             kind = mo.lastgroup
             value = mo.group()
             if kind == 'MISMATCH':
-                print(code.split("\n")[line_num-1])
-                raise RuntimeError("Syntax error on line: %d: %s\n%s", line_num, value)
+                raise RuntimeError("Syntax error on line: %d: %s\n%s" % (line_num, value, self.line(line_num)))
             elif kind == 'SKIP':
                 pass
             elif kind == 'COMMENT':
@@ -128,10 +137,12 @@ class Tokenizer:
         self.__tokens.append(Token('NEWLINE', '\n', line_num))
 
     def peek(self):
-        return self.__tokens[0]
+        return self.__tokens[self.__pos]
 
     def pop(self):
-        return self.__tokens.pop(0)
+        self.__last = self.__tokens[self.__pos]
+        self.__pos += 1
+        return self.__last
 
     def expect(self, kind, value=None):
         pop = self.pop()
@@ -140,8 +151,19 @@ class Tokenizer:
                 raise SyntaxError("%s != %s:%s" % (pop, kind, value))
             raise SyntaxError("%s != %s" % (pop, kind))
 
+    def lineNr(self):
+        """
+            Line number of the token that is being processed, for error reporting.
+        """
+        if self.__last is not None:
+            return self.__last.line_nr
+        return self.__tokens[0].line_nr
+
+    def line(self, line_nr):
+        return self.__lines[line_nr - 1] if 0 < line_nr <= len(self.__lines) else ""
+
     def __bool__(self):
-        return bool(self.__tokens)
+        return self.__pos < len(self.__tokens)
 
 
 class Assembler:
@@ -174,6 +196,9 @@ class Assembler:
         self.__label = {}
         self.__link = {}
         self.__scope = None
+        # (offset, mnemonic, line number) of each instruction and data line, used by the optimizer and the listing.
+        self.__instructions = []
+        self.__literal_jumps = {}
 
         self.__tok = None
 
@@ -203,6 +228,8 @@ class Assembler:
                     while not self.__tok.pop().isA('NEWLINE'):
                         pass
                 elif start.kind == 'ID':
+                    if not self.__tok.peek().isA('LABEL'):
+                        self.__instructions.append((len(self.__result), start.value, start.line_nr))
                     if start.value == 'DB':
                         self.instrDB()
                         self.__tok.expect('NEWLINE')
@@ -316,7 +343,7 @@ class Assembler:
                 else:
                     raise SyntaxError(start)
         except SyntaxError:
-            print("Syntax error on line: %s" % code.split("\n")[self.__tok.peek().line_nr-1])
+            print("Syntax error on line %d: %s" % (self.__tok.lineNr(), self.__tok.line(self.__tok.lineNr())))
             raise
 
     def insert8(self, expr):
@@ -669,6 +696,12 @@ class Assembler:
             return t
         if t.kind not in ('ID', 'NUMBER', 'STRING'):
             raise SyntaxError
+        if t.isA('ID', 'BANK') and self.__tok.peek().isA('OP', '('):
+            # Bank number of a symbol, only known once the code is placed by the Linker.
+            self.__tok.pop()
+            symbol = self.parseUnary()
+            self.__tok.expect('OP', ')')
+            return OP('BANK', symbol)
         if t.isA('ID') and t.value in CONST_MAP:
             t.kind = 'NUMBER'
             t.value = CONST_MAP[t.value]
@@ -676,6 +709,111 @@ class Assembler:
             t.value = self.__scope + t.value
         return t
 
+    # Opcodes that set all flags without reading them, and the and/or/xor opcodes that set the flags like "and a" does.
+    FLAG_SETTERS = set(range(0x80, 0x88)) | set(range(0x90, 0x98)) | set(range(0xA0, 0xC0)) | {0xC6, 0xD6, 0xE6, 0xEE, 0xF6, 0xFE}
+    LOGIC_OPS = set(range(0xA0, 0xB8)) | {0xE6, 0xEE, 0xF6}
+    # Absolute jumps and their relative counterparts.
+    JP_TO_JR = {0xC3: 0x18, 0xC2: 0x20, 0xCA: 0x28, 0xD2: 0x30, 0xDA: 0x38}
+
+    def optimize(self):
+        """
+            Optional peephole optimization and branch relaxation, to be called between process() and link().
+            Only changes code in ways that keep the behaviour the same:
+                ld a, $00 -> xor a, when the next instruction sets all flags anyway.
+                and a after and/or/xor is removed, the flags are already set from A (only the H flag can differ).
+                call X + ret -> jp X, when nothing jumps to the ret.
+                jp to a label in this code -> jr, when it is in range.
+            Returns a dict with the bytes and M-cycles (4 clocks each) saved, and a list of the changes.
+        """
+        stats = {"bytes": 0, "cycles": 0, "changes": []}
+        # jr instructions with a number instead of a label have their displacement in the code already.
+        # These are moved along with the code, a target outside of this code is at a fixed place.
+        self.__literal_jumps = {}
+        for offset, mnemonic, _ in self.__instructions:
+            if mnemonic == 'JR' and offset + 1 not in self.__link:
+                target = offset + 2 + ((self.__result[offset + 1] ^ 0x80) - 0x80)
+                self.__literal_jumps[offset + 1] = (target, not 0 <= target <= len(self.__result))
+
+        def change(index, description, size, cycles):
+            stats["bytes"] += size
+            stats["cycles"] += cycles
+            stats["changes"].append("%04x: %s" % (self.__instructions[index][0], description))
+
+        changed = True
+        while changed:
+            changed = False
+            label_offsets = set(self.__label.values())
+            for index in range(len(self.__instructions)):
+                offset, mnemonic, _ = self.__instructions[index]
+                size = self.__instructionSize(index)
+                data = self.__result[offset:offset + size]
+                next_offset = offset + size
+                if mnemonic == 'LD' and data == b'\x3E\x00' and offset + 1 not in self.__link \
+                        and index + 1 < len(self.__instructions) and self.__instructions[index + 1][1] not in ('DB', 'DW') \
+                        and self.__result[next_offset] in self.FLAG_SETTERS:
+                    change(index, "ld a, $00 -> xor a", 1, 1)
+                    self.__result[offset] = 0xAF
+                    self.__removeBytes(offset + 1, 1)
+                elif mnemonic == 'AND' and data == b'\xA7' and offset not in label_offsets and index > 0 \
+                        and self.__instructions[index - 1][1] in ('AND', 'OR', 'XOR') \
+                        and self.__result[self.__instructions[index - 1][0]] in self.LOGIC_OPS:
+                    change(index, "removed and a", 1, 1)
+                    self.__removeBytes(offset, 1)
+                    del self.__instructions[index]
+                elif mnemonic == 'CALL' and size == 3 and data[0] == 0xCD and next_offset not in label_offsets \
+                        and index + 1 < len(self.__instructions) and self.__instructions[index + 1][1] == 'RET' \
+                        and self.__result[next_offset] == 0xC9:
+                    change(index, "call + ret -> jp", 1, 6)
+                    self.__result[offset] = 0xC3
+                    self.__removeBytes(next_offset, 1)
+                    del self.__instructions[index + 1]
+                elif mnemonic == 'JP' and size == 3 and data[0] in self.JP_TO_JR and self.__jumpTarget(offset + 1) is not None:
+                    target = self.__jumpTarget(offset + 1)
+                    if target > offset:
+                        target -= 1
+                    if -128 <= target - (offset + 2) <= 127:
+                        change(index, "jp -> jr", 1, 1)
+                        self.__result[offset] = self.JP_TO_JR[data[0]]
+                        self.__link[offset + 1] = (Assembler.LINK_REL8, self.__link[offset + 1][1])
+                        self.__removeBytes(offset + 2, 1)
+                    else:
+                        continue
+                else:
+                    continue
+                changed = True
+                break
+
+        for jump_offset, (target, external) in self.__literal_jumps.items():
+            displacement = target - (jump_offset + 1)
+            assert -128 <= displacement <= 127, "Relative jump out of range after optimizing"
+            self.__result[jump_offset] = displacement & 0xFF
+        return stats
+
+    def __instructionSize(self, index):
+        if index + 1 < len(self.__instructions):
+            return self.__instructions[index + 1][0] - self.__instructions[index][0]
+        return len(self.__result) - self.__instructions[index][0]
+
+    def __jumpTarget(self, link_offset):
+        # Offset of the label a jump goes to, only for plain labels of this code.
+        if link_offset not in self.__link:
+            return None
+        link_type, expr = self.__link[link_offset]
+        if link_type != Assembler.LINK_ABS16 or not isinstance(expr, Token) or not expr.isA('ID'):
+            return None
+        return self.__label.get(expr.value)
+
+    def __removeBytes(self, offset, count):
+        # Remove bytes from the result, and move everything after them.
+        del self.__result[offset:offset + count]
+        for label, label_offset in self.__label.items():
+            if label_offset > offset:
+                self.__label[label] = label_offset - count
+        self.__link = {(link_offset - count if link_offset > offset else link_offset): link for link_offset, link in self.__link.items()}
+        self.__instructions = [(instr_offset - count if instr_offset > offset else instr_offset, mnemonic, line_nr) for instr_offset, mnemonic, line_nr in self.__instructions]
+        self.__literal_jumps = {(jump_offset - count if jump_offset > offset else jump_offset): (target - count if not external and target > offset else target, external)
+                                for jump_offset, (target, external) in self.__literal_jumps.items()}
+
     def link(self):
         for offset, (link_type, expr) in self.__link.items():
             expr = self.resolveExpr(expr)
@@ -700,6 +838,7 @@ class Assembler:
         if expr is None:
             return None
         elif isinstance(expr, OP):
+            assert expr.op != 'BANK', "BANK() can only be used in sections placed by the Linker"
             return OP.make(expr.op, self.resolveExpr(expr.left), self.resolveExpr(expr.right))
         elif expr.isA('ID') and expr.value in self.__label:
             return Token('NUMBER', self.__label[expr.value] + self.__base_address, expr.line_nr)
@@ -711,6 +850,182 @@ class Assembler:
     def getLabels(self):
         return self.__label.items()
 
+    def getListing(self):
+        """
+            Returns the listing of the linked code, as lines with the address, the bytes, the M-cycles and the source line.
+            Conditional branches show the cycles when not taken and when taken, calls only the cycles of the call itself.
+        """
+        base_address = max(self.__base_address, 0)
+        result = []
+        for index, (offset, mnemonic, line_nr) in enumerate(self.__instructions):
+            data = self.__result[offset:offset + self.__instructionSize(index)]
+            cycles = "" if mnemonic in ('DB', 'DW') or not data else timing.formatCycles(data)
+            result.append("%04X  %-12s %5s  %s" % (base_address + offset, binascii.hexlify(data).decode("ascii").upper(), cycles, self.__tok.line(line_nr).strip()))
+        return result
+
+    def getSection(self, name, *, bank=None, address=None, align=1):
+        assert self.__base_address < 0, "Sections are relocatable, they are assembled without a base address"
+        links = [(offset, link_type, expr) for offset, (link_type, expr) in sorted(self.__link.items())]
+        return Section(name, bytes(self.__result), dict(self.__label), links, bank=bank, address=address, align=align)
+
+
+class Section:
+    """
+        Relocatable piece of assembled code, placed in the rom by a Linker.
+        Labels are offsets from the start of the section, links are the (offset, link type, expression) values
+        that are filled in when the section is placed.
+        Labels without a "." are exported to the other sections, all other symbols that are used are imported.
+    """
+    def __init__(self, name, data, labels, links, *, bank=None, address=None, align=1):
+        self.name = name
+        self.data = data
+        self.labels = labels
+        self.links = links
+        # Fixed placement of the section, without an address the Linker allocates space in the bank, or in any bank.
+        self.bank = bank
+        self.address = address
+        self.align = align
+
+    def __len__(self):
+        return len(self.data)
+
+    def exports(self):
+        return {label: offset for label, offset in self.labels.items() if "." not in label}
+
+    def imports(self):
+        result = set()
+        for _, _, expr in self.links:
+            result.update(name for name in _exprSymbols(expr) if name not in self.labels)
+        return result
+
+    def __repr__(self):
+        return "[Section:%s:%d]" % (self.name, len(self.data))
+
+
+def _exprSymbols(expr):
+    if isinstance(expr, OP):
+        yield from _exprSymbols(expr.left)
+        if expr.right is not None:
+            yield from _exprSymbols(expr.right)
+    elif isinstance(expr, REF):
+        yield from _exprSymbols(expr.expr)
+    elif expr.isA('ID'):
+        yield expr.value
+
+
+class Linker:
+    """
+        Places sections in the rom and resolves the symbols between them.
+        Sections with a fixed address are placed there, the others are allocated from the free space (a FreeList of
+        offsets in each bank) in their own bank, or in the first switchable bank with room when they have no bank.
+        Addresses are as seen by the cpu, so $0000-$3FFF for bank 0 and $4000-$7FFF for the other banks.
+    """
+    def __init__(self):
+        self.__sections = {}
+        self.__symbols = {}
+        # Labels exported by more than one section, these can only be used inside their own section.
+        self.__ambiguous = set()
+        self.__placement = {}
+        self.__output = {}
+
+    def add(self, section):
+        assert section.name not in self.__sections, "Duplicate section: %s" % (section.name)
+        self.__sections[section.name] = section
+
+    def define(self, name, bank, address):
+        """
+            Define a symbol that is not part of any section, like an existing routine in the rom.
+        """
+        self.__symbols[name.upper()] = (bank, address)
+
+    def link(self, free_space=None):
+        """
+            Place all sections and resolve their links. Returns the (bank, address) of each section by name.
+        """
+        # Fixed sections first so the others cannot take their space, then the largest sections first for the tightest fit.
+        sections = sorted(self.__sections.values(), key=lambda section: (section.address is None, -len(section)))
+        for section in sections:
+            if section.address is not None:
+                bank = section.bank if section.bank is not None else 0
+                assert bank == 0 or section.address >= 0x4000, "Section %s is not at a banked address" % (section.name)
+                if free_space is not None:
+                    free_space.claim(bank, section.address & 0x3FFF, (section.address & 0x3FFF) + len(section))
+                address = section.address
+            else:
+                assert free_space is not None, "Section %s needs free space to be placed in" % (section.name)
+                # Bank 0 is always mapped in and has little room to spare, so it is only used for sections that ask for it.
+                banks = [section.bank] if section.bank is not None else [bank for bank in free_space.banks() if bank != 0]
+                offset = None
+                for bank in banks:
+                    offset = free_space.allocate(len(section), bank, align=section.align)
+                    if offset is not None:
+                        break
+                assert offset is not None, "Not enough room for section %s (%d bytes)" % (section.name, len(section))
+                address = offset if bank == 0 else offset | 0x4000
+            self.__placement[section.name] = (bank, address)
+            for label, offset in section.exports().items():
+                if label in self.__symbols:
+                    self.__ambiguous.add(label)
+                self.__symbols[label] = (bank, address + offset)
+
+        for section in sections:
+            bank, address = self.__placement[section.name]
+            data = bytearray(section.data)
+            for offset, link_type, expr in section.links:
+                # The expressions of a section are shared with the cache, so they are resolved on a copy.
+                expr = self.__resolve(copy.deepcopy(expr), section)
+                assert expr.isA('NUMBER'), "Unresolved %s in section %s" % (expr, section.name)
+                value = expr.value
+                if link_type == Assembler.LINK_REL8:
+                    byte = value - (address + offset + 1)
+                    assert -128 <= byte <= 127, "Relative jump out of range in section %s" % (section.name)
+                    data[offset] = byte & 0xFF
+                elif link_type == Assembler.LINK_ABS8:
+                    assert 0 <= value <= 0xFF
+                    data[offset] = value & 0xFF
+                elif link_type == Assembler.LINK_ABS16:
+                    assert 0 <= value <= 0xFFFF
+                    data[offset] = value & 0xFF
+                    data[offset + 1] = value >> 8
+                else:
+                    raise RuntimeError
+            self.__output[section.name] = data
+        return dict(self.__placement)
+
+    def __lookup(self, name, section):
+        if name in section.labels:
+            bank, address = self.__placement[section.name]
+            return bank, address + section.labels[name]
+        assert name in self.__symbols, "Unknown symbol %s in section %s" % (name, section.name)
+        assert name not in self.__ambiguous, "Symbol %s used in section %s is defined more than once" % (name, section.name)
+        return self.__symbols[name]
+
+    def __resolve(self, expr, section):
+        if expr is None:
+            return None
+        elif isinstance(expr, OP):
+            if expr.op == 'BANK':
+                assert expr.left.isA('ID'), "BANK() needs a symbol"
+                return Token('NUMBER', self.__lookup(expr.left.value, section)[0], expr.left.line_nr)
+            return OP.make(expr.op, self.__resolve(expr.left, section), self.__resolve(expr.right, section))
+        elif expr.isA('ID'):
+            return Token('NUMBER', self.__lookup(expr.value, section)[1], expr.line_nr)
+        return expr
+
+    def getData(self, name):
+        return self.__output[name]
+
+    def getSymbols(self):
+        return dict(self.__symbols)
+
+    def write(self, rom):
+        """
+            Write all linked sections into the rom.
+        """
+        for name, data in self.__output.items():
+            bank, address = self.__placement[name]
+            rom.patch(bank, address & 0x3FFF, None, binascii.hexlify(data))
+
 
 def const(name, value):
     name = name.upper()
@@ -722,14 +1037,124 @@ def resetConsts():
     CONST_MAP.clear()
 
 
-def ASM(code, base_address=None, labels_result=None):
-    asm = Assembler(base_address)
-    asm.process(code)
-    asm.link()
+# Assembled code is cached, keyed on a hash of the code and everything the result depends on.
+# The in memory cache keeps the most recently used results, the optional disk cache keeps everything between runs.
+ASM_CACHE_SIZE = 1024
+_ID_REGEX = re.compile(r'[A-Z_][A-Z0-9_]*')
+_asm_cache = collections.OrderedDict()
+_asm_disk_cache = None
+_asm_disk_cache_filename = None
+_asm_disk_cache_modified = False
+
+
+def _asmSourceHash():
+    # Results from a different version of the assembler are not valid.
+    h = hashlib.sha256()
+    for filename in (__file__, utils.__file__):
+        h.update(open(filename, "rb").read())
+    return h.hexdigest()
+
+
+def _asmCacheKey(code, base_address):
+    consts = sorted((name, CONST_MAP[name]) for name in set(_ID_REGEX.findall(code.upper())) if name in CONST_MAP)
+    # m"" strings are formatted with the replacement names.
+    names = sorted((str(key), value) for key, value in utils._NAMES.items()) if 'm"' in code else None
+    return hashlib.sha256(repr((code, base_address, consts, names)).encode("utf-8")).hexdigest()
+
+
+def enableDiskCache(filename):
+    """
+        Load and use the on disk cache of assembled code, saveDiskCache writes it back with the new results.
+    """
+    global _asm_disk_cache, _asm_disk_cache_filename, _asm_disk_cache_modified
+    _asm_disk_cache = {}
+    _asm_disk_cache_filename = filename
+    _asm_disk_cache_modified = False
+    if os.path.exists(filename):
+        try:
+            source_hash, cache = pickle.load(open(filename, "rb"))
+            if source_hash == _asmSourceHash():
+                _asm_disk_cache = cache
+        except Exception as e:
+            print("Ignoring broken cache file %s: %s" % (filename, e))
+
+
+def saveDiskCache():
+    global _asm_disk_cache_modified
+    if _asm_disk_cache is None or not _asm_disk_cache_modified:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(_asm_disk_cache_filename)), exist_ok=True)
+    f = open(_asm_disk_cache_filename + ".tmp", "wb")
+    pickle.dump((_asmSourceHash(), _asm_disk_cache), f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.replace(_asm_disk_cache_filename + ".tmp", _asm_disk_cache_filename)
+    _asm_disk_cache_modified = False
+
+
+def _cacheGet(key):
+    result = _asm_cache.get(key)
+    if result is not None:
+        _asm_cache.move_to_end(key)
+    elif _asm_disk_cache is not None:
+        result = _asm_disk_cache.get(key)
+        if result is not None:
+            _cachePut(key, result, disk=False)
+    return result
+
+
+def _cachePut(key, result, *, disk=True):
+    global _asm_disk_cache_modified
+    _asm_cache[key] = result
+    if len(_asm_cache) > ASM_CACHE_SIZE:
+        _asm_cache.popitem(last=False)
+    if disk and _asm_disk_cache is not None:
+        _asm_disk_cache[key] = result
+        _asm_disk_cache_modified = True
+
+
+def ASM(code, base_address=None, labels_result=None, *, optimize=False, stats_result=None, listing_result=None):
+    """
+        Assemble code at base_address and return the result as hex.
+        With optimize the peephole optimizer runs on the code, stats_result is then updated with what it saved.
+        The lines of the listing, with the M-cycles per instruction, are added to listing_result.
+    """
+    key = _asmCacheKey(code, base_address if not optimize else ("optimize", base_address))
+    # The listing needs the source lines, which are not cached.
+    result = _cacheGet(key) if listing_result is None else None
+    if result is None:
+        asm = Assembler(base_address)
+        asm.process(code)
+        stats = asm.optimize() if optimize else None
+        asm.link()
+        result = (binascii.hexlify(asm.getResult()), list(asm.getLabels()), stats)
+        _cachePut(key, result)
+        if listing_result is not None:
+            listing_result.extend(asm.getListing())
+    data, labels, stats = result
     if labels_result is not None:
-        for label, offset in asm.getLabels():
+        for label, offset in labels:
             labels_result[label] = base_address + offset
-    return binascii.hexlify(asm.getResult())
+    if stats_result is not None and stats is not None:
+        stats_result["bytes"] = stats_result.get("bytes", 0) + stats["bytes"]
+        stats_result["cycles"] = stats_result.get("cycles", 0) + stats["cycles"]
+        stats_result.setdefault("changes", []).extend(stats["changes"])
+    return data
+
+
+def assembleSection(name, code, *, bank=None, address=None, align=1, optimize=False):
+    """
+        Assemble code into a relocatable Section, to be placed by a Linker. Sections are cached just like ASM results.
+    """
+    key = _asmCacheKey(code, ("section", name, bank, address, align, optimize))
+    section = _cacheGet(key)
+    if section is None:
+        asm = Assembler()
+        asm.process(code)
+        if optimize:
+            asm.optimize()
+        section = asm.getSection(name, bank=bank, address=address, align=align)
+        _cachePut(key, section)
+    return section
 
 
 def allOpcodesTest():
@@ -1,12 +1,24 @@
 import binascii
+import bisect
 import struct
 
+from ips import findDifference
+
 
 class BPS:
-    def __init__(self, old, new, patch):
-        self.old = open(old, "rb").read()
-        self.new = open(new, "rb").read()
-        self.patch = open(patch, "wb")
+    # old and new can be filenames or the rom data itself.
+    # ranges is an optional list of (start, end) areas that can contain changes, see ROM.getDirtyRanges
+    def __init__(self, old, new, patch, *, ranges=None):
+        if isinstance(old, str):
+            old = open(old, "rb").read()
+        if isinstance(new, str):
+            new = open(new, "rb").read()
+        self.old = old
+        self.new = new
+        if ranges is None:
+            ranges = [(0, len(self.new))]
+        self.ranges = ranges
+        self.range_ends = [end for start, end in ranges]
         self.patch = bytearray(b'BPS1')
         self.number(len(self.old))
         self.number(len(self.new))
@@ -16,9 +28,7 @@ class BPS:
         self.dstRelOff = 0
 
         while self.ptr < len(self.new):
-            unchanged_size = 0
-            while self.ptr + unchanged_size < len(self.old) and self.old[self.ptr+unchanged_size] == self.new[self.ptr+unchanged_size]:
-                unchanged_size += 1
+            unchanged_size = min(self.findChange(self.ptr), len(self.old)) - self.ptr
             if unchanged_size > 0:
                 self.number(0 | ((unchanged_size - 1) << 2))
                 self.ptr += unchanged_size
@@ -47,6 +57,17 @@ class BPS:
         self.patch += struct.pack("<I", binascii.crc32(self.patch))
         open(patch, "wb").write(self.patch)
 
+    def findChange(self, ptr):
+        # Find the first byte at or after ptr that is different between old and new, only looking inside the ranges.
+        idx = bisect.bisect_right(self.range_ends, ptr)
+        while idx < len(self.ranges):
+            start, end = self.ranges[idx]
+            ptr = findDifference(self.old, self.new, max(ptr, start), end)
+            if ptr < end:
+                return ptr
+            idx += 1
+        return len(self.new)
+
     def signednumber(self, value):
         if value < 0:
             self.number((-value << 1) | 1)
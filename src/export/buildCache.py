@@ -0,0 +1,48 @@
+import os
+import pickle
+
+
+class BuildCache:
+    """
+        Encoded rom data of imported files, so a build only needs to encode the files that changed since the last one.
+        Entries are stored with a digest of their source data, an entry with a different digest is encoded again.
+        The key identifies the base rom and toolbox code the entries were encoded for, any change to it drops all entries.
+    """
+    VERSION = 1
+
+    def __init__(self, filename, key):
+        self.__filename = filename
+        self.__key = key
+        self.__old = {}
+        self.__new = {}
+        self.__modified = False
+        if os.path.exists(filename):
+            try:
+                version, key, entries = pickle.load(open(filename, "rb"))
+                if version == self.VERSION and key == self.__key:
+                    self.__old = entries
+            except Exception as e:
+                print("Ignoring broken cache file %s: %s" % (filename, e))
+
+    def get(self, name, digest):
+        entry = self.__old.get(name)
+        if entry is None or entry[0] != digest:
+            return None
+        self.__new[name] = entry
+        return entry[1]
+
+    def put(self, name, digest, value):
+        self.__new[name] = (digest, value)
+        self.__modified = True
+
+    def save(self):
+        # Entries that were not used in this build are dropped, those files no longer exist.
+        if not self.__modified and self.__new.keys() == self.__old.keys():
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.__filename)), exist_ok=True)
+        f = open(self.__filename + ".tmp", "wb")
+        pickle.dump((self.VERSION, self.__key, self.__new), f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.replace(self.__filename + ".tmp", self.__filename)
+        self.__old = dict(self.__new)
+        self.__modified = False
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+
+import romCache
+
+
+class Manifest:
+    """
+        Hashes of the rom data that each exported file was made from, stored next to the exported data.
+        A new export only needs to write the files of which the source data changed. Files are keyed on their path
+        relative to the export path. Any change to the toolbox code invalidates all files, as it can change the output.
+    """
+    FILENAME = "manifest.json"
+    VERSION = 1
+
+    def __init__(self, path):
+        self.__path = path
+        self.__source_hash = romCache.sourceHash()
+        self.__old = {}
+        self.__new = {}
+        filename = os.path.join(path, self.FILENAME)
+        if os.path.exists(filename):
+            try:
+                data = json.load(open(filename, "rt"))
+            except ValueError:
+                data = {}
+            if data.get("version") == self.VERSION and data.get("source") == self.__source_hash:
+                self.__old = data.get("files", {})
+
+    @staticmethod
+    def hashSources(*sources):
+        """
+            Hash of the source data of a file, sources can be bytes like objects, numbers, strings or None.
+        """
+        h = hashlib.sha256()
+        for source in sources:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                data = bytes(source)
+            else:
+                data = repr(source).encode("utf-8")
+            h.update(b"%d:" % (len(data)))
+            h.update(data)
+        return h.hexdigest()
+
+    def __key(self, filename):
+        return os.path.relpath(filename, self.__path).replace(os.sep, "/")
+
+    def isCurrent(self, filename, digest):
+        """
+            True if the file exists and was exported from source data with the same hash.
+        """
+        key = self.__key(filename)
+        return self.__new.get(key, self.__old.get(key)) == digest and os.path.exists(filename)
+
+    def update(self, filename, digest):
+        self.__new[self.__key(filename)] = digest
+
+    def updateAll(self, entries):
+        for filename, digest in entries.items():
+            self.update(filename, digest)
+
+    def save(self):
+        filename = os.path.join(self.__path, self.FILENAME)
+        data = json.dumps({"version": self.VERSION, "source": self.__source_hash, "files": dict(sorted(self.__new.items()))}, indent=1)
+        if os.path.exists(filename) and open(filename, "rt").read() == data:
+            return
+        f = open(filename + ".tmp", "wt")
+        f.write(data)
+        f.close()
+        os.replace(filename + ".tmp", filename)
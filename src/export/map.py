@@ -1,23 +1,18 @@
+import numpy
 import PIL.Image
 import backgroundEditor
+import tileCodec
+from export.manifest import Manifest
 
 
-def exportMap(rom, filename):
-    tiles = []
-    for idx in range(0x80):
-        tile = bytearray(0x100)
-        data = rom.banks[0x2C][0x3800+idx*0x10:0x3810+idx*0x10]
-        for y in range(8):
-            a = data[y * 2 + 0]
-            b = data[y * 2 + 1]
-            for x in range(8):
-                c = 0
-                if a & (0x80 >> x):
-                    c |= 1
-                if b & (0x80 >> x):
-                    c |= 2
-                tile[x + y * 8] = c
-        tiles.append(tile)
+def exportMap(rom, filename, *, manifest=None):
+    if manifest is not None:
+        digest = Manifest.hashSources(rom.banks[0x2C][0x3800:0x4000], rom.banks[0x20][0x168B:0x188B], rom.banks[0x21][0x386E:0x386E + 8 * 4 * 2])
+        current = manifest.isCurrent(filename, digest)
+        manifest.update(filename, digest)
+        if current:
+            return
+    tiles = tileCodec.decode(rom.banks[0x2C][0x3800:0x3800+0x80*0x10])
 
     palette_addr = 0x386E
     palette = []
@@ -31,44 +26,29 @@ def exportMap(rom, filename):
         b = ((pal >> 10) & 0x1F) << 3
         palette += [r, g, b]
 
-    result = PIL.Image.new("P", (16*8, 16*8))
-    result.putpalette(palette)
-    tile_data = rom.banks[0x20][0x168B:0x178B]
-    attr_data = rom.banks[0x20][0x178B:0x188B]
-    for y in range(16):
-        for x in range(16):
-            idx = tile_data[x + y * 16]
-            idx = idx + 0x10 if idx < 0xF0 else idx - 0xF0
-            attr = attr_data[x + y * 16]
-            result.paste(PIL.Image.frombytes("P", (8, 8), bytes([i + attr * 4 for i in tiles[idx]])), (x*8, y*8))
+    tile_data = numpy.frombuffer(bytes(rom.banks[0x20][0x168B:0x178B]), dtype=numpy.uint8)
+    attr_data = numpy.frombuffer(bytes(rom.banks[0x20][0x178B:0x188B]), dtype=numpy.uint8)
+    tile_data = numpy.where(tile_data < 0xF0, tile_data + 0x10, tile_data - 0xF0)
+    pixels = tiles[tile_data] + (attr_data * 4)[:, None, None]
+    result = tileCodec.toImage(tileCodec.arrange(pixels, 16), palette)
     result.save(filename)
 
 
+def mostUsedPalette(tile):
+    # The palette that most pixels use, on a tie the one that is used first by a later pixel.
+    palettes, first_use, counts = numpy.unique(tile.reshape(-1) >> 2, return_index=True, return_counts=True)
+    most_used = counts == counts.max()
+    return int(palettes[most_used][numpy.argmax(first_use[most_used])])
+
+
 def importMap(rom, filename):
     try:
         image = PIL.Image.open(filename)
     except:
         return
-    tiles = []
-    attrs = []
-    for y in range(16):
-        for x in range(16):
-            tile = bytearray(16)
-            pals = {}
-            for yn in range(8):
-                a = 0
-                b = 0
-                for xn in range(8):
-                    c = image.getpixel((x*8+xn, y*8+yn))
-                    if c & 1:
-                        a |= 0x80 >> xn
-                    if c & 2:
-                        b |= 0x80 >> xn
-                    pals[c >> 2] = pals.get(c >> 2, 0) + 1
-                tile[yn * 2 + 0] = a
-                tile[yn * 2 + 1] = b
-            tiles.append(bytes(tile))
-            attrs.append(sorted(pals.items(), key=lambda n: n[1])[-1][0])
+    pixels = tileCodec.split(tileCodec.fromImage(image)[:16*8, :16*8])
+    tiles = [tileCodec.encode(tile[None]) for tile in pixels]
+    attrs = [mostUsedPalette(tile) for tile in pixels]
 
     tile_index = 0x0A
     known_tiles = {}
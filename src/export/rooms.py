@@ -1,12 +1,14 @@
 import os
+import multiprocessing
 import roomEditor
 import json
 import entityData
-import PIL.Image
 import PIL.ImageDraw
 import constants
+import tileCodec
 import re as regex
 from assembler import ASM
+from export.manifest import Manifest
 
 
 MINIMAP_TYPES = {
@@ -195,18 +197,25 @@ class RoomData:
         self.tileset_image = data["tilesets"][0]["image"]
 
 
-def exportRooms(rom, path):
+def exportRooms(rom, path, *, jobs=1, manifest=None):
     os.makedirs(path, exist_ok=True)
+    save_manifest = manifest is None
+    if manifest is None:
+        manifest = Manifest(path)
 
     # Create overworld world file
-    json.dump({
-        "maps": [
-            {"fileName": "room%03x.json" % (n), "height": 128, "width": 160, "x": (n & 0x0F) * 160, "y": (n >> 4) * 128}
-            for n in range(0x100)
-        ],
-        "onlyShowAdjacentMaps": False,
-        "type": "world"
-    }, open(os.path.join(path, "overworld.world"), "wt"))
+    world_filename = os.path.join(path, "overworld.world")
+    world_digest = Manifest.hashSources("overworld")
+    if not manifest.isCurrent(world_filename, world_digest):
+        json.dump({
+            "maps": [
+                {"fileName": "room%03x.json" % (n), "height": 128, "width": 160, "x": (n & 0x0F) * 160, "y": (n >> 4) * 128}
+                for n in range(0x100)
+            ],
+            "onlyShowAdjacentMaps": False,
+            "type": "world"
+        }, open(world_filename, "wt"))
+    manifest.update(world_filename, world_digest)
 
     map_per_room = {}
     minimap_data = {}
@@ -222,15 +231,19 @@ def exportRooms(rom, path):
             for x in range(8):
                 if layout[x+y * 8] != 0 or (n == 11 and x == 1 and y == 3):
                     map_per_room[layout[x+y * 8]+offset] = n
-        json.dump({
-            "maps": [
-                {"fileName": "room%03x.json" % (layout[x+y*8] + offset), "height": 128, "width": 160, "x": x * 160,
-                 "y": y * 128}
-                for y in range(8) for x in range(8) if layout[x+y*8] != 0 or (n == 11 and x == 1 and y == 3)
-            ],
-            "onlyShowAdjacentMaps": False,
-            "type": "world"
-        }, open(os.path.join(path, "layout_%02x.world" % (n)), "wt"))
+        world_filename = os.path.join(path, "layout_%02x.world" % (n))
+        world_digest = Manifest.hashSources(layout, offset)
+        if not manifest.isCurrent(world_filename, world_digest):
+            json.dump({
+                "maps": [
+                    {"fileName": "room%03x.json" % (layout[x+y*8] + offset), "height": 128, "width": 160, "x": x * 160,
+                     "y": y * 128}
+                    for y in range(8) for x in range(8) if layout[x+y*8] != 0 or (n == 11 and x == 1 and y == 3)
+                ],
+                "onlyShowAdjacentMaps": False,
+                "type": "world"
+            }, open(world_filename, "wt"))
+        manifest.update(world_filename, world_digest)
 
         minimap = None
         if n < 8:
@@ -256,233 +269,237 @@ def exportRooms(rom, path):
                 map_per_room[warp.room] = warp.map_nr
 
     # Export each room.
-    for room_index in ALL_ROOMS:
-        re = roomEditor.RoomEditor(rom, room_index)
-        data = RoomData()
-
-        if re.overlay:
-            # Overworld rooms
-            for y in range(8):
-                for x in range(10):
-                    data.setTile(x, y, re.overlay[x+y*10])
-            # In a few cases, there is a warp capable tile overwritten by a different tile to place a future warp there
-            # We need to ensure that this is kept else we wrong warp.
-            for obj in re.objects:
-                if obj.type_id in roomEditor.WARP_TYPE_IDS and re.overlay[obj.x + obj.y * 10] != obj.type_id:
-                    if obj.type_id != 0xE1 or re.overlay[obj.x + obj.y * 10] != 0x53: # Ignore the waterfall 'caves'
-                        data.addObject(obj.x, obj.y, "%02X" % (obj.type_id), "HIDDEN_TILE")
-                if obj.type_id == 0xC5 and re.overlay[obj.x + obj.y * 10] == 0xC4:
-                    # Pushable gravestones have the wrong overlay by default
-                    re.overlay[obj.x + obj.y * 10] = 0xC5
-                if obj.type_id == 0xDC:
-                    # Flowers above the rooster windmill need a different tile
-                    data.addObject(obj.x, obj.y, "%02X" % (obj.type_id), "HIDDEN_TILE")
+    if jobs > 1:
+        # Workers get a copy of the parsed rom, with fork it is shared with this process until it is written to.
+        # Which is never, as the export only reads from the rom.
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+        with context.Pool(jobs, initializer=_initExportWorker, initargs=(rom, path, sidescroller_rooms, minimap_data, manifest)) as pool:
+            for result in pool.map(_exportRoomWorker, ALL_ROOMS, chunksize=8):
+                manifest.updateAll(result)
+    else:
+        for room_index in ALL_ROOMS:
+            manifest.updateAll(exportRoom(rom, path, room_index, sidescroller_rooms, minimap_data, manifest))
+    if save_manifest:
+        manifest.save()
+
+
+_export_worker_state = None
+
+
+def _initExportWorker(*state):
+    global _export_worker_state
+    _export_worker_state = state
+
+
+def _exportRoomWorker(room_index):
+    rom, path, sidescroller_rooms, minimap_data, manifest = _export_worker_state
+    return exportRoom(rom, path, room_index, sidescroller_rooms, minimap_data, manifest)
+
+
+def _saveImage(img, filename):
+    # Write to a temporary file first, rooms exported in parallel can write the same tileset image at the same time.
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    img.save(tmp_filename, format="PNG")
+    os.replace(tmp_filename, filename)
+
+
+def exportRoom(rom, path, room_index, sidescroller_rooms, minimap_data, manifest):
+    """
+        Export a single room and its tileset image. Files that the manifest knows to be current are not written again.
+        Returns the hashes of the source data of the files, to update the manifest with.
+    """
+    re = roomEditor.RoomEditor(rom, room_index)
+    room_nr = room_index
+    if isinstance(room_nr, str):
+        room_nr = int(room_nr[3:], 16)
+
+    anim_addr = {2: 0x2B00, 3: 0x2C00, 4: 0x2D00, 5: 0x2E00, 6: 0x2F00, 7: 0x2D00, 8: 0x3000, 9: 0x3100, 10: 0x3200, 11: 0x2A00, 12: 0x3300, 13: 0x3500, 14: 0x3600, 15: 0x3400, 16: 0x3700}.get(re.animation_id, 0x0000)
+    if room_nr < 0x100:
+        tileset_index = rom.banks[0x3F][0x2f00 + room_nr]
+        attributedata_bank = rom.banks[0x1A][0x2476 + room_nr]
+        attributedata_addr = rom.banks[0x1A][0x1E76 + room_nr * 2]
+        attributedata_addr |= rom.banks[0x1A][0x1E76 + room_nr * 2 + 1] << 8
+        attributedata_addr -= 0x4000
+        palette_index = rom.banks[0x21][0x02EF + room_nr]
+
+        tileset_image = "ZZ_overworld_%02x_%02x_%02x_%02x_%04x.png" % (tileset_index, re.animation_id, palette_index, attributedata_bank, attributedata_addr)
+        image_filename = os.path.join(path, tileset_image)
+
+        tilemap = rom.banks[0x2F][tileset_index*0x100:tileset_index*0x100+0x200]
+        tilemap += rom.banks[0x2C][0x1200:0x1800]
+        tilemap += rom.banks[0x2C][0x0800:0x1000]
+        tilemap[0x6C0:0x700] = rom.banks[0x2C][anim_addr:anim_addr + 0x40]
+
+        metatile_info = rom.banks[0x1A][0x2B1D:0x2B1D + 0x400]
+        attrtile_info = rom.banks[attributedata_bank][attributedata_addr:attributedata_addr + 0x400]
+
+        palette_addr = rom.banks[0x21][0x02B1 + palette_index * 2]
+        palette_addr |= rom.banks[0x21][0x02B1 + palette_index * 2 + 1] << 8
+        palette_addr -= 0x4000
+
+        palette = []
+        for n in range(8*4):
+            p0 = rom.banks[0x21][palette_addr]
+            p1 = rom.banks[0x21][palette_addr + 1]
+            pal = p0 | p1 << 8
+            palette_addr += 2
+            r = (pal & 0x1F) << 3
+            g = ((pal >> 5) & 0x1F) << 3
+            b = ((pal >> 10) & 0x1F) << 3
+            palette += [r, g, b]
+
+        # Make some adjustments for special tiles
+        # Bush with hole or stairs
+        metatile_info[0xD3 * 4 + 1] = metatile_info[0xE8 * 4 + 1]
+        metatile_info[0xD3 * 4 + 3] = metatile_info[0xC6 * 4 + 3]
+
+        image_digest = Manifest.hashSources(tilemap, metatile_info, attrtile_info, bytes(palette))
+        if not manifest.isCurrent(image_filename, image_digest):
+            img = tileCodec.toImage(tileCodec.renderMetatiles(tilemap, metatile_info, attrtile_info), palette)
+            _saveImage(img, image_filename)
+    else:
+        tileset_index = rom.banks[0x20][0x2eB3 + room_nr - 0x100]
+
+        if room_index in sidescroller_rooms:
+            tileset_image = "ZZ_sidescroll_%02x.png" % (re.animation_id)
         else:
-            for y in range(8):
-                for x in range(10):
-                    data.setTile(x, y, re.floor_object & 0x0F)
-            for n, tile in enumerate(INDOOR_ROOM_TEMPLATES[re.floor_object >> 4].tiles):
-                if tile is not None:
-                    data.tiles[n] = tile
-
-            for obj in re.objects:
-                if isinstance(obj, roomEditor.ObjectHorizontal):
-                    for n in range(obj.count):
-                        data.setTile(obj.x + n, obj.y, obj.type_id)
-                elif isinstance(obj, roomEditor.ObjectVertical):
-                    for n in range(obj.count):
-                        data.setTile(obj.x, obj.y + n, obj.type_id)
-                elif isinstance(obj, roomEditor.ObjectWarp):
-                    pass
-                elif obj.type_id in INDOOR_MACROS:
-                    for x, y, type_id in INDOOR_MACROS[obj.type_id]:
-                        data.setTile(obj.x + x, obj.y + y, type_id)
-                else:
-                    data.setTile(obj.x, obj.y, obj.type_id)
-
-        for entity in re.entities:
-            data.addObject(entity[0], entity[1], entityData.NAME[entity[2]], "ENTITY")
-
-        warps = re.getWarps()
-        for index in range(4):
-            if index < len(warps):
-                warp = warps[index]
-                if warp.warp_type == 1:
-                    data.properties["warp%d_type" % (index)] = "indoor"
-                elif warp.warp_type == 2:
-                    data.properties["warp%d_type" % (index)] = "sidescroll"
-                else:
-                    data.properties["warp%d_type" % (index)] = "overworld"
-                data.properties["warp%d_map" % (index)] = "%02x" % (warp.map_nr)
-                data.properties["warp%d_room" % (index)] = "%02x" % (warp.room & 0xFF)
-                data.properties["warp%d_target" % (index)] = "%d,%d" % (warp.target_x, warp.target_y)
-            else:
-                data.properties["warp%d_type" % (index)] = "none"
-                data.properties["warp%d_map" % (index)] = "00"
-                data.properties["warp%d_room" % (index)] = "00"
-                data.properties["warp%d_target" % (index)] = "0,0"
+            tileset_image = "ZZ_indoor_%02x_%02x.png" % (tileset_index, re.animation_id)
+        image_filename = os.path.join(path, tileset_image)
 
-        room_nr = room_index
-        if isinstance(room_nr, str):
-            room_nr = int(room_nr[3:], 16)
+        metatile_info = rom.banks[0x08][0x0000:0x0400]
 
-        anim_addr = {2: 0x2B00, 3: 0x2C00, 4: 0x2D00, 5: 0x2E00, 6: 0x2F00, 7: 0x2D00, 8: 0x3000, 9: 0x3100, 10: 0x3200, 11: 0x2A00, 12: 0x3300, 13: 0x3500, 14: 0x3600, 15: 0x3400, 16: 0x3700}.get(re.animation_id, 0x0000)
-        if room_nr < 0x100:
-            tileset_index = rom.banks[0x3F][0x2f00 + room_nr]
-            attributedata_bank = rom.banks[0x1A][0x2476 + room_nr]
-            attributedata_addr = rom.banks[0x1A][0x1E76 + room_nr * 2]
-            attributedata_addr |= rom.banks[0x1A][0x1E76 + room_nr * 2 + 1] << 8
-            attributedata_addr -= 0x4000
-            palette_index = rom.banks[0x21][0x02EF + room_nr]
-
-            data.tileset_image = "ZZ_overworld_%02x_%02x_%02x_%02x_%04x.png" % (tileset_index, re.animation_id, palette_index, attributedata_bank, attributedata_addr)
-
-            if not os.path.exists(os.path.join(path, data.tileset_image)):
-                tilemap = rom.banks[0x2F][tileset_index*0x100:tileset_index*0x100+0x200]
-                tilemap += rom.banks[0x2C][0x1200:0x1800]
-                tilemap += rom.banks[0x2C][0x0800:0x1000]
-                tilemap[0x6C0:0x700] = rom.banks[0x2C][anim_addr:anim_addr + 0x40]
-
-                metatile_info = rom.banks[0x1A][0x2B1D:0x2B1D + 0x400]
-                attrtile_info = rom.banks[attributedata_bank][attributedata_addr:attributedata_addr + 0x400]
-
-                palette_addr = rom.banks[0x21][0x02B1 + palette_index * 2]
-                palette_addr |= rom.banks[0x21][0x02B1 + palette_index * 2 + 1] << 8
-                palette_addr -= 0x4000
-
-                palette = []
-                for n in range(8*4):
-                    p0 = rom.banks[0x21][palette_addr]
-                    p1 = rom.banks[0x21][palette_addr + 1]
-                    pal = p0 | p1 << 8
-                    palette_addr += 2
-                    r = (pal & 0x1F) << 3
-                    g = ((pal >> 5) & 0x1F) << 3
-                    b = ((pal >> 10) & 0x1F) << 3
-                    palette += [r, g, b]
-
-                # Make some adjustments for special tiles
-                # Bush with hole or stairs
-                metatile_info[0xD3 * 4 + 1] = metatile_info[0xE8 * 4 + 1]
-                metatile_info[0xD3 * 4 + 3] = metatile_info[0xC6 * 4 + 3]
-
-                img = PIL.Image.new("P", (16*16, 16*16))
-                img.putpalette(palette)
-                def drawTile(x, y, index, attr):
-                    for py in range(8):
-                        a = tilemap[index * 16 + py * 2]
-                        b = tilemap[index * 16 + py * 2 + 1]
-                        if attr & 0x40:
-                            a = tilemap[index * 16 + 14 - py * 2]
-                            b = tilemap[index * 16 + 15 - py * 2]
-                        for px in range(8):
-                            bit = 0x80 >> px
-                            if attr & 0x20:
-                                bit = 0x01 << px
-                            c = (attr & 7) << 2
-                            if a & bit:
-                                c |= 1
-                            if b & bit:
-                                c |= 2
-                            img.putpixel((x+px, y+py), c)
-                for x in range(16):
-                    for y in range(16):
-                        idx = x+y*16
-                        metatiles = metatile_info[idx*4:idx*4+4]
-                        attrtiles = attrtile_info[idx*4:idx*4+4]
-                        drawTile(x * 16 + 0, y * 16 + 0, metatiles[0], attrtiles[0])
-                        drawTile(x * 16 + 8, y * 16 + 0, metatiles[1], attrtiles[1])
-                        drawTile(x * 16 + 0, y * 16 + 8, metatiles[2], attrtiles[2])
-                        drawTile(x * 16 + 8, y * 16 + 8, metatiles[3], attrtiles[3])
-                img.save(os.path.join(path, data.tileset_image))
+        if room_index in sidescroller_rooms:
+            # TODO: Tileset depends on map [0x3000:0x3800] is the other set
+            tilemap = rom.banks[0x0D][0x3800:0x4000]
         else:
-            tileset_index = rom.banks[0x20][0x2eB3 + room_nr - 0x100]
-
-            if room_index in sidescroller_rooms:
-                data.tileset_image = "ZZ_sidescroll_%02x.png" % (re.animation_id)
+            if tileset_index == 0xFF:
+                tilemap = bytearray(0x100)
             else:
-                data.tileset_image = "ZZ_indoor_%02x_%02x.png" % (tileset_index, re.animation_id)
-
-            if not os.path.exists(os.path.join(path, data.tileset_image)):
-                metatile_info = rom.banks[0x08][0x0000:0x0400]
-
-                if room_index in sidescroller_rooms:
-                    # TODO: Tileset depends on map [0x3000:0x3800] is the other set
-                    tilemap = rom.banks[0x0D][0x3800:0x4000]
-                else:
-                    if tileset_index == 0xFF:
-                        tilemap = bytearray(0x100)
-                    else:
-                        tilemap = rom.banks[0x0D][0x1000 + tileset_index * 0x100:0x1100 + tileset_index * 0x100]
-                    tilemap += rom.banks[0x0D][0x2100:0x2200]
-                    tilemap += rom.banks[0x0D][0x0000:0x0600]
-                tilemap += bytearray(0x700)
-                tilemap += rom.banks[0x12][0x3800:0x3900]
-
-                tilemap[0x6C0:0x700] = rom.banks[0x2C][anim_addr:anim_addr + 0x40]
-
-                img = PIL.Image.new("P", (16*16, 16*16))
-                img.putpalette([255,255,255, 170,170,170, 85,85,85, 0,0,0, 255,0,0])
-                def drawTile(x, y, index, attr):
-                    for py in range(8):
-                        a = tilemap[index * 16 + py * 2]
-                        b = tilemap[index * 16 + py * 2 + 1]
-                        if attr & 0x40:
-                            a = tilemap[index * 16 + 14 - py * 2]
-                            b = tilemap[index * 16 + 15 - py * 2]
-                        for px in range(8):
-                            bit = 0x80 >> px
-                            if attr & 0x20:
-                                bit = 0x01 << px
-                            c = (attr & 7) << 2
-                            if a & bit:
-                                c |= 1
-                            if b & bit:
-                                c |= 2
-                            img.putpixel((x+px, y+py), c)
-                for x in range(16):
-                    for y in range(16):
-                        idx = x+y*16
-                        metatiles = metatile_info[idx*4:idx*4+4]
-                        attrtiles = (0, 0, 0, 0)
-                        drawTile(x * 16 + 0, y * 16 + 0, metatiles[0], attrtiles[0])
-                        drawTile(x * 16 + 8, y * 16 + 0, metatiles[1], attrtiles[1])
-                        drawTile(x * 16 + 0, y * 16 + 8, metatiles[2], attrtiles[2])
-                        drawTile(x * 16 + 8, y * 16 + 8, metatiles[3], attrtiles[3])
-                if room_index not in sidescroller_rooms:
-                    # Overlay some information about certain tiles
-                    draw = PIL.ImageDraw.Draw(img)
-                    for n, s in [
-                            (0x47, "B"), (0x48, "B"), (0x49, "B"), (0x4A, "B"),
-                            (0xA7, "P"),
-                            (0xBF, "H"),
-                        ] + [(tile, "X") for tile in INDOOR_MACROS.keys()]:
-                        draw.text(((n % 16) * 16 + 4, (n // 16) * 16), s, fill=4)
-                img.save(os.path.join(path, data.tileset_image))
-
-        if room_index in minimap_data:
-            data.properties["MINIMAP"] = minimap_data[room_index]
-
-        if isinstance(room_nr, int):
-            data.properties["CHESTITEM"] = [k for k, v in constants.CHEST_ITEMS.items() if v == rom.banks[0x14][0x0560 + room_nr]][0]
-            data.properties["ROOMITEM"] = [k for k, v in constants.CHEST_ITEMS.items() if v == rom.banks[0x3E][0x3800 + room_nr]][0]
-            if room_nr > 0x100:
-                event = rom.banks[0x14][room_nr - 0x100]
-                data.properties["EVENT_TRIGGER"] = EVENT_TRIGGERS[event & 0x1F]
-                data.properties["EVENT_ACTION"] = EVENT_ACTIONS[event >> 5]
-            if room_nr < 0x100:
-                data.properties["MUSIC"] = "%02x" % (rom.banks[0x02][room_nr])
-
-        if isinstance(room_index, str):
-            roomfilename = "room%s.json" % (room_index)
+                tilemap = rom.banks[0x0D][0x1000 + tileset_index * 0x100:0x1100 + tileset_index * 0x100]
+            tilemap += rom.banks[0x0D][0x2100:0x2200]
+            tilemap += rom.banks[0x0D][0x0000:0x0600]
+        tilemap += bytearray(0x700)
+        tilemap += rom.banks[0x12][0x3800:0x3900]
+
+        tilemap[0x6C0:0x700] = rom.banks[0x2C][anim_addr:anim_addr + 0x40]
+
+        image_digest = Manifest.hashSources(tilemap, metatile_info, room_index in sidescroller_rooms)
+        if not manifest.isCurrent(image_filename, image_digest):
+            img = tileCodec.toImage(tileCodec.renderMetatiles(tilemap, metatile_info), [255,255,255, 170,170,170, 85,85,85, 0,0,0, 255,0,0])
+            if room_index not in sidescroller_rooms:
+                # Overlay some information about certain tiles
+                draw = PIL.ImageDraw.Draw(img)
+                for n, s in [
+                        (0x47, "B"), (0x48, "B"), (0x49, "B"), (0x4A, "B"),
+                        (0xA7, "P"),
+                        (0xBF, "H"),
+                    ] + [(tile, "X") for tile in INDOOR_MACROS.keys()]:
+                    draw.text(((n % 16) * 16 + 4, (n // 16) * 16), s, fill=4)
+            _saveImage(img, image_filename)
+    result = {image_filename: image_digest}
+
+    if isinstance(room_index, str):
+        roomfilename = os.path.join(path, "room%s.json" % (room_index))
+    else:
+        roomfilename = os.path.join(path, "room%03x.json" % (room_index))
+    # Everything the room file is made from, the tile and object data, the entities, the items and the properties.
+    room_sources = [re.animation_id, re.floor_object, b"".join(bytes(obj.export()) for obj in re.objects), re.entities, re.overlay,
+                    minimap_data.get(room_index), tileset_image, rom.banks[0x14][0x0560 + room_nr], rom.banks[0x3E][0x3800 + room_nr]]
+    if room_nr > 0x100:
+        room_sources.append(rom.banks[0x14][room_nr - 0x100])
+    if room_nr < 0x100:
+        room_sources.append(rom.banks[0x02][room_nr])
+    room_digest = Manifest.hashSources(*room_sources)
+    result[roomfilename] = room_digest
+    if manifest.isCurrent(roomfilename, room_digest):
+        return result
+
+    data = RoomData()
+
+    if re.overlay:
+        # Overworld rooms
+        for y in range(8):
+            for x in range(10):
+                data.setTile(x, y, re.overlay[x+y*10])
+        # In a few cases, there is a warp capable tile overwritten by a different tile to place a future warp there
+        # We need to ensure that this is kept else we wrong warp.
+        for obj in re.objects:
+            if obj.type_id in roomEditor.WARP_TYPE_IDS and re.overlay[obj.x + obj.y * 10] != obj.type_id:
+                if obj.type_id != 0xE1 or re.overlay[obj.x + obj.y * 10] != 0x53: # Ignore the waterfall 'caves'
+                    data.addObject(obj.x, obj.y, "%02X" % (obj.type_id), "HIDDEN_TILE")
+            if obj.type_id == 0xC5 and re.overlay[obj.x + obj.y * 10] == 0xC4:
+                # Pushable gravestones have the wrong overlay by default
+                re.overlay[obj.x + obj.y * 10] = 0xC5
+            if obj.type_id == 0xDC:
+                # Flowers above the rooster windmill need a different tile
+                data.addObject(obj.x, obj.y, "%02X" % (obj.type_id), "HIDDEN_TILE")
+    else:
+        for y in range(8):
+            for x in range(10):
+                data.setTile(x, y, re.floor_object & 0x0F)
+        for n, tile in enumerate(INDOOR_ROOM_TEMPLATES[re.floor_object >> 4].tiles):
+            if tile is not None:
+                data.tiles[n] = tile
+
+        for obj in re.objects:
+            if isinstance(obj, roomEditor.ObjectHorizontal):
+                for n in range(obj.count):
+                    data.setTile(obj.x + n, obj.y, obj.type_id)
+            elif isinstance(obj, roomEditor.ObjectVertical):
+                for n in range(obj.count):
+                    data.setTile(obj.x, obj.y + n, obj.type_id)
+            elif isinstance(obj, roomEditor.ObjectWarp):
+                pass
+            elif obj.type_id in INDOOR_MACROS:
+                for x, y, type_id in INDOOR_MACROS[obj.type_id]:
+                    data.setTile(obj.x + x, obj.y + y, type_id)
+            else:
+                data.setTile(obj.x, obj.y, obj.type_id)
+
+    for entity in re.entities:
+        data.addObject(entity[0], entity[1], entityData.NAME[entity[2]], "ENTITY")
+
+    warps = re.getWarps()
+    for index in range(4):
+        if index < len(warps):
+            warp = warps[index]
+            if warp.warp_type == 1:
+                data.properties["warp%d_type" % (index)] = "indoor"
+            elif warp.warp_type == 2:
+                data.properties["warp%d_type" % (index)] = "sidescroll"
+            else:
+                data.properties["warp%d_type" % (index)] = "overworld"
+            data.properties["warp%d_map" % (index)] = "%02x" % (warp.map_nr)
+            data.properties["warp%d_room" % (index)] = "%02x" % (warp.room & 0xFF)
+            data.properties["warp%d_target" % (index)] = "%d,%d" % (warp.target_x, warp.target_y)
         else:
-            roomfilename = "room%03x.json" % (room_index)
-        data.save(os.path.join(path, roomfilename))
+            data.properties["warp%d_type" % (index)] = "none"
+            data.properties["warp%d_map" % (index)] = "00"
+            data.properties["warp%d_room" % (index)] = "00"
+            data.properties["warp%d_target" % (index)] = "0,0"
+
+    if room_index in minimap_data:
+        data.properties["MINIMAP"] = minimap_data[room_index]
+
+    if isinstance(room_nr, int):
+        data.properties["CHESTITEM"] = [k for k, v in constants.CHEST_ITEMS.items() if v == rom.banks[0x14][0x0560 + room_nr]][0]
+        data.properties["ROOMITEM"] = [k for k, v in constants.CHEST_ITEMS.items() if v == rom.banks[0x3E][0x3800 + room_nr]][0]
+        if room_nr > 0x100:
+            event = rom.banks[0x14][room_nr - 0x100]
+            data.properties["EVENT_TRIGGER"] = EVENT_TRIGGERS[event & 0x1F]
+            data.properties["EVENT_ACTION"] = EVENT_ACTIONS[event >> 5]
+        if room_nr < 0x100:
+            data.properties["MUSIC"] = "%02x" % (rom.banks[0x02][room_nr])
+
+    data.tileset_image = tileset_image
+    data.save(roomfilename)
+    return result
 
 
-def importRooms(rom, path):
+def importRooms(rom, path, *, cache=None):
     minimap_address_per_room = {}
     map_per_room = {}
+    layouts = []
     for n in range(13):
         if n < 8:
             minimapaddr = 0x2479 + n * 64
@@ -494,7 +511,8 @@ def importRooms(rom, path):
             minimapaddr = None
 
         layout = bytearray(64)
-        data = json.load(open(os.path.join(path, "layout_%02x.world" % (n)), "rt"))
+        layouts.append(open(os.path.join(path, "layout_%02x.world" % (n)), "rb").read())
+        data = json.loads(layouts[-1])
         for mapdata in data["maps"]:
             x = mapdata["x"] // 160
             y = mapdata["y"] // 128
@@ -515,185 +533,37 @@ def importRooms(rom, path):
     overworld_warp_rooms = []
     indoor_warp_rooms = {n: [] for n in range(8)}
 
+    # The layouts decide the minimap and warp data of the rooms, so each room is encoded again when they change.
+    layout_digest = Manifest.hashSources(*layouts)
     for room_index in ALL_ROOMS:
         if isinstance(room_index, str):
             roomfilename = "room%s.json" % (room_index)
         else:
             roomfilename = "room%03x.json" % (room_index)
-
-        data = RoomData()
-        data.load(os.path.join(path, roomfilename))
-
-        re = roomEditor.RoomEditor(rom, room_index)
-        re.objects = []
-        re.entities = []
-
-        if re.overlay:
-            for n in range(80):
-                re.overlay[n] = data.tiles[n]
-            # Simplify the overworld tiles, so they take less storage
-            for n in range(80):
-                if data.tiles[n] in {0x25, 0x26, 0x27, 0x28, 0x29, 0x2A, 0x2B, 0x2C, 0x2D, 0x2E, 0x2F,
-                            0x33, 0x34, 0x37, 0x38, 0x39, 0x3A, 0x3B, 0x3C, 0x3D, 0x3E, 0x3F,
-                            0x48, 0x49, 0x4B, 0x4C, 0x4E,
-                            0x80, 0x81, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89, 0x8A, 0x8B, 0x8C, 0x8D, 0x8E, 0x8F}:
-                    data.tiles[n] = 0x3A  # Solid tiles
-                elif data.tiles[n] in {0x08, 0x09, 0x0C, 0x44,
-                            0xF5, 0xF6, 0xF7, 0xF8, 0xF9, 0xFA, 0xFB, 0xFC, 0xFD, 0xFE, 0xFF}:
-                    data.tiles[n] = 0x04  # Open tiles
-
-            # Count each tile, to figure out the most common one as floor tile
-            counts = {}
-            for n in data.tiles:
-                counts[n] = counts.get(n, 0) + 1
-            re.floor_object = max(counts, key=counts.get)
-            template_tiles = [re.floor_object] * 80
-        else:
-            counts = {}
-            for n in data.tiles:
-                if n < 0x10: # Indoor maps can only have one of the first 16 metatiles as floor
-                    counts[n] = counts.get(n, 0) + 1
-            if counts:
-                re.floor_object = max(counts, key=counts.get)
-            else:
-                re.floor_object = 0
-
-            # Figure out which room template to apply.
-            template_scores = {}
-            for template_index, template in enumerate(INDOOR_ROOM_TEMPLATES):
-                score = 0
-                for idx, tile in enumerate(template.tiles):
-                    if tile is None:
-                        tile = re.floor_object
-                    if data.tiles[idx] == tile:
-                        score += 1
-                template_scores[template_index] = score
-            template_index = max(template_scores, key=template_scores.get)
-            template_tiles = [re.floor_object] * 80
-            for idx, tile in enumerate(INDOOR_ROOM_TEMPLATES[template_index].tiles):
-                if tile is not None:
-                    template_tiles[idx] = tile
-            re.floor_object |= template_index << 4
-
-        done = [data.tiles[n] == template_tiles[n] for n in range(80)]
-        for y in range(8):
-            for x in range(10):
-                obj = data.tiles[x + y * 10]
-                if done[x + y * 10]:
-                    continue
-                # Figure out if we should do a horizontal or vertical strip.
-                xmax = x
-                for x1 in range(x + 1, 10):
-                    if done[x1 + y * 10]:
-                        break
-                    if data.tiles[x1 + y * 10] == obj:
-                        xmax = x1
-                ymax = y
-                for y1 in range(y + 1, 8):
-                    if done[x + y1 * 10]:
-                        break
-                    if data.tiles[x + y1 * 10] == obj:
-                        ymax = y1
-                w = xmax - x + 1
-                h = ymax - y + 1
-                if re.overlay and obj in {0xE1, 0xE2, 0xE3, 0xBA}:
-                    w, h = 1, 1 # Do not encode entrances into strips
-                if w > h:
-                    for n in range(w):
-                        if data.tiles[x + n + y * 10] == obj:
-                            done[x + n + y * 10] = True
-                    re.objects.append(roomEditor.ObjectHorizontal(x, y, obj, w))
-                elif h > 1:
-                    for n in range(h):
-                        if data.tiles[x + (y + n) * 10] == obj:
-                            done[x + (y + n) * 10] = True
-                    re.objects.append(roomEditor.ObjectVertical(x, y, obj, h))
-                else:
-                    # Check if we might be able to place a macro
-                    macro = None
-                    for macro_id, macro_data in INDOOR_MACROS.items():
-                        if macro_data[0][2] == obj:
-                            ok = True
-                            for mx, my, mobj in macro_data:
-                                if x + mx >= 10 or y + my >= 8 or data.tiles[x + mx + (y + my) * 10] != mobj:
-                                    ok = False
-                                    break
-                            if ok:
-                                macro = macro_id
-                    if macro and re.room >= 0x100:
-                        re.objects.append(roomEditor.Object(x, y, macro))
-                        for mx, my, mobj in INDOOR_MACROS[macro]:
-                            done[x + mx + (y + my) * 10] = True
-                    else:
-                        done[x + y * 10] = True
-                        re.objects.append(roomEditor.Object(x, y, obj))
-
-        for x, y, name, objtype in data.objects:
-            if objtype == 'ENTITY':
-                re.entities.append((x, y, entityData.NAME.index(name)))
-                if name == "WARP":
-                    if room_index < 0x100 and room_index != 0x0CE:
-                        overworld_warp_rooms.append(room_index)
-                    elif room_index in map_per_room and map_per_room[room_index] < 8:
-                        indoor_warp_rooms[map_per_room[room_index]].append(room_index)
-            elif objtype == 'HIDDEN_TILE':
-                re.objects.insert(0, roomEditor.Object(x,y, int(name, 16)))
-        for n in range(4):
-            if "warp%d_type" % (n) in data.properties:
-                wtype = data.properties["warp%d_type" % (n)].lower()
-                wmap = data.properties["warp%d_map" % (n)]
-                wroom = data.properties["warp%d_room" % (n)]
-                wtarget = [int(n.strip()) for n in data.properties["warp%d_target" % (n)].split(",")]
-                if wtype == "overworld":
-                    wtype = 0
-                elif wtype == "indoor":
-                    wtype = 1
-                elif wtype == "sidescroll":
-                    wtype = 2
-                else:
-                    continue
-                re.objects.append(roomEditor.ObjectWarp(wtype, int(wmap, 16), int(wroom, 16), wtarget[0], wtarget[1]))
-
-        if isinstance(room_index, int):
-            rom.banks[0x14][0x0560 + room_index] = constants.CHEST_ITEMS[data.properties["CHESTITEM"]]
-            rom.banks[0x3E][0x3800 + room_index] = constants.CHEST_ITEMS[data.properties["ROOMITEM"]]
-
-            if room_index > 0x100 and "EVENT_TRIGGER" in data.properties:
-                event = EVENT_TRIGGERS.index(data.properties["EVENT_TRIGGER"])
-                event |= EVENT_ACTIONS.index(data.properties["EVENT_ACTION"]) << 5
-                if data.properties["EVENT_TRIGGER"] == "NONE" or data.properties["EVENT_ACTION"] == "NONE":
-                    event = 0
-                rom.banks[0x14][room_index - 0x100] = event
-
-            if room_index in minimap_address_per_room:
-                for addr in minimap_address_per_room[room_index]:
-                    assert data.properties["MINIMAP"] in MINIMAP_TYPES.values(), hex(room_index)
-                    rom.banks[0x02][addr] = [k for k, v in MINIMAP_TYPES.items() if v == data.properties["MINIMAP"]][0]
-
-            m = regex.match(r"ZZ_overworld_([0-9a-f]+)_([0-9a-f]+)_([0-9a-f]+)_([0-9a-f]+)_([0-9a-f]+).png", data.tileset_image)
-            if m and room_index < 0x100:
-                tileset_index, re.animation_id, palette_index, attributedata_bank, attributedata_addr = [int(v, 16) for v in m.groups()]
-                attributedata_addr += 0x4000
-
-                rom.banks[0x3F][0x2f00 + room_index] = tileset_index
-                rom.banks[0x1A][0x2476 + room_index] = attributedata_bank
-                rom.banks[0x1A][0x1E76 + room_index * 2] = attributedata_addr & 0xFF
-                rom.banks[0x1A][0x1E76 + room_index * 2 + 1] = (attributedata_addr >> 8)
-                rom.banks[0x21][0x02EF + room_index] = palette_index
-
-            m = regex.match(r"ZZ_indoor_([0-9a-f]+)_([0-9a-f]+).png", data.tileset_image)
-            if m and room_index >= 0x100:
-                tileset_index, re.animation_id = [int(v, 16) for v in m.groups()]
-                rom.banks[0x20][0x2eB3 + room_index - 0x100] = tileset_index
-
-            m = regex.match(r"ZZ_sidescroll_([0-9a-f]+).png", data.tileset_image)
-            if m and room_index >= 0x100:
-                re.animation_id = [int(v, 16) for v in m.groups()][0]
-
-            if room_index < 0x100 and "MUSIC" in data.properties:
-                rom.banks[0x02][room_index] = int(data.properties["MUSIC"], 16)
-
-        re.store(rom)
+        roomfilename = os.path.join(path, roomfilename)
+
+        encoded = None
+        if cache is not None:
+            digest = Manifest.hashSources(open(roomfilename, "rb").read(), layout_digest)
+            encoded = cache.get(room_index, digest)
+        if encoded is None:
+            encoded = encodeRoom(rom, roomfilename, room_index, minimap_address_per_room.get(room_index, []))
+            if cache is not None:
+                cache.put(room_index, digest, encoded)
+
+        objects_raw, entities_raw, overlay, side_table_data, warp_count = encoded
+        roomEditor.storeObjects(rom, room_index, objects_raw)
+        if entities_raw is not None:
+            rom.entities[room_index] = entities_raw
+        if overlay is not None:
+            roomEditor.storeOverlay(rom, room_index, overlay)
+        for bank, addr, value in side_table_data:
+            rom.banks[bank][addr] = value
+        for n in range(warp_count):
+            if room_index < 0x100 and room_index != 0x0CE:
+                overworld_warp_rooms.append(room_index)
+            elif room_index in map_per_room and map_per_room[room_index] < 8:
+                indoor_warp_rooms[map_per_room[room_index]].append(room_index)
 
     assert len(overworld_warp_rooms) <= 4, "Only up to 4 overworld warps are supported: %s" % (["%03x" % (room) for room in overworld_warp_rooms])
     code = ""
@@ -714,3 +584,183 @@ def importRooms(rom, path):
         assert len(indoor_warp_rooms[n]) < 3, "Dungeon %d has more then 2 miniboss warps: %s" % (n + 1, [hex(room) for room in indoor_warp_rooms[n]])
         for idx, room in enumerate(indoor_warp_rooms[n]):
             rom.banks[0x19][0x0201 + n * 2 + idx] = room & 0xFF
+
+
+def encodeRoom(rom, filename, room_index, minimap_addresses):
+    """
+        Encode a room json file into the data that importRooms stores in the rom, without changing the rom:
+        the raw objects, the raw entities, the overlay, the (bank, address, value) writes to other tables
+        and the number of warp entities.
+    """
+    side_table_data = []
+    warp_count = 0
+    data = RoomData()
+    data.load(filename)
+
+    re = roomEditor.RoomEditor(rom, room_index)
+    re.objects = []
+    re.entities = []
+
+    if re.overlay:
+        re.overlay = bytes(data.tiles)
+        # Simplify the overworld tiles, so they take less storage
+        for n in range(80):
+            if data.tiles[n] in {0x25, 0x26, 0x27, 0x28, 0x29, 0x2A, 0x2B, 0x2C, 0x2D, 0x2E, 0x2F,
+                        0x33, 0x34, 0x37, 0x38, 0x39, 0x3A, 0x3B, 0x3C, 0x3D, 0x3E, 0x3F,
+                        0x48, 0x49, 0x4B, 0x4C, 0x4E,
+                        0x80, 0x81, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89, 0x8A, 0x8B, 0x8C, 0x8D, 0x8E, 0x8F}:
+                data.tiles[n] = 0x3A  # Solid tiles
+            elif data.tiles[n] in {0x08, 0x09, 0x0C, 0x44,
+                        0xF5, 0xF6, 0xF7, 0xF8, 0xF9, 0xFA, 0xFB, 0xFC, 0xFD, 0xFE, 0xFF}:
+                data.tiles[n] = 0x04  # Open tiles
+
+        # Count each tile, to figure out the most common one as floor tile
+        counts = {}
+        for n in data.tiles:
+            counts[n] = counts.get(n, 0) + 1
+        re.floor_object = max(counts, key=counts.get)
+        template_tiles = [re.floor_object] * 80
+    else:
+        counts = {}
+        for n in data.tiles:
+            if n < 0x10: # Indoor maps can only have one of the first 16 metatiles as floor
+                counts[n] = counts.get(n, 0) + 1
+        if counts:
+            re.floor_object = max(counts, key=counts.get)
+        else:
+            re.floor_object = 0
+
+        # Figure out which room template to apply.
+        template_scores = {}
+        for template_index, template in enumerate(INDOOR_ROOM_TEMPLATES):
+            score = 0
+            for idx, tile in enumerate(template.tiles):
+                if tile is None:
+                    tile = re.floor_object
+                if data.tiles[idx] == tile:
+                    score += 1
+            template_scores[template_index] = score
+        template_index = max(template_scores, key=template_scores.get)
+        template_tiles = [re.floor_object] * 80
+        for idx, tile in enumerate(INDOOR_ROOM_TEMPLATES[template_index].tiles):
+            if tile is not None:
+                template_tiles[idx] = tile
+        re.floor_object |= template_index << 4
+
+    done = [data.tiles[n] == template_tiles[n] for n in range(80)]
+    for y in range(8):
+        for x in range(10):
+            obj = data.tiles[x + y * 10]
+            if done[x + y * 10]:
+                continue
+            # Figure out if we should do a horizontal or vertical strip.
+            xmax = x
+            for x1 in range(x + 1, 10):
+                if done[x1 + y * 10]:
+                    break
+                if data.tiles[x1 + y * 10] == obj:
+                    xmax = x1
+            ymax = y
+            for y1 in range(y + 1, 8):
+                if done[x + y1 * 10]:
+                    break
+                if data.tiles[x + y1 * 10] == obj:
+                    ymax = y1
+            w = xmax - x + 1
+            h = ymax - y + 1
+            if re.overlay and obj in {0xE1, 0xE2, 0xE3, 0xBA}:
+                w, h = 1, 1 # Do not encode entrances into strips
+            if w > h:
+                for n in range(w):
+                    if data.tiles[x + n + y * 10] == obj:
+                        done[x + n + y * 10] = True
+                re.objects.append(roomEditor.ObjectHorizontal(x, y, obj, w))
+            elif h > 1:
+                for n in range(h):
+                    if data.tiles[x + (y + n) * 10] == obj:
+                        done[x + (y + n) * 10] = True
+                re.objects.append(roomEditor.ObjectVertical(x, y, obj, h))
+            else:
+                # Check if we might be able to place a macro
+                macro = None
+                for macro_id, macro_data in INDOOR_MACROS.items():
+                    if macro_data[0][2] == obj:
+                        ok = True
+                        for mx, my, mobj in macro_data:
+                            if x + mx >= 10 or y + my >= 8 or data.tiles[x + mx + (y + my) * 10] != mobj:
+                                ok = False
+                                break
+                        if ok:
+                            macro = macro_id
+                if macro and re.room >= 0x100:
+                    re.objects.append(roomEditor.Object(x, y, macro))
+                    for mx, my, mobj in INDOOR_MACROS[macro]:
+                        done[x + mx + (y + my) * 10] = True
+                else:
+                    done[x + y * 10] = True
+                    re.objects.append(roomEditor.Object(x, y, obj))
+
+    for x, y, name, objtype in data.objects:
+        if objtype == 'ENTITY':
+            re.entities.append((x, y, entityData.NAME.index(name)))
+            if name == "WARP":
+                warp_count += 1
+        elif objtype == 'HIDDEN_TILE':
+            re.objects.insert(0, roomEditor.Object(x,y, int(name, 16)))
+    for n in range(4):
+        if "warp%d_type" % (n) in data.properties:
+            wtype = data.properties["warp%d_type" % (n)].lower()
+            wmap = data.properties["warp%d_map" % (n)]
+            wroom = data.properties["warp%d_room" % (n)]
+            wtarget = [int(n.strip()) for n in data.properties["warp%d_target" % (n)].split(",")]
+            if wtype == "overworld":
+                wtype = 0
+            elif wtype == "indoor":
+                wtype = 1
+            elif wtype == "sidescroll":
+                wtype = 2
+            else:
+                continue
+            re.objects.append(roomEditor.ObjectWarp(wtype, int(wmap, 16), int(wroom, 16), wtarget[0], wtarget[1]))
+
+    if isinstance(room_index, int):
+        side_table_data.append((0x14, 0x0560 + room_index, constants.CHEST_ITEMS[data.properties["CHESTITEM"]]))
+        side_table_data.append((0x3E, 0x3800 + room_index, constants.CHEST_ITEMS[data.properties["ROOMITEM"]]))
+
+        if room_index > 0x100 and "EVENT_TRIGGER" in data.properties:
+            event = EVENT_TRIGGERS.index(data.properties["EVENT_TRIGGER"])
+            event |= EVENT_ACTIONS.index(data.properties["EVENT_ACTION"]) << 5
+            if data.properties["EVENT_TRIGGER"] == "NONE" or data.properties["EVENT_ACTION"] == "NONE":
+                event = 0
+            side_table_data.append((0x14, room_index - 0x100, event))
+
+        for addr in minimap_addresses:
+            assert data.properties["MINIMAP"] in MINIMAP_TYPES.values(), hex(room_index)
+            side_table_data.append((0x02, addr, [k for k, v in MINIMAP_TYPES.items() if v == data.properties["MINIMAP"]][0]))
+
+        m = regex.match(r"ZZ_overworld_([0-9a-f]+)_([0-9a-f]+)_([0-9a-f]+)_([0-9a-f]+)_([0-9a-f]+).png", data.tileset_image)
+        if m and room_index < 0x100:
+            tileset_index, re.animation_id, palette_index, attributedata_bank, attributedata_addr = [int(v, 16) for v in m.groups()]
+            attributedata_addr += 0x4000
+
+            side_table_data.append((0x3F, 0x2f00 + room_index, tileset_index))
+            side_table_data.append((0x1A, 0x2476 + room_index, attributedata_bank))
+            side_table_data.append((0x1A, 0x1E76 + room_index * 2, attributedata_addr & 0xFF))
+            side_table_data.append((0x1A, 0x1E76 + room_index * 2 + 1, (attributedata_addr >> 8)))
+            side_table_data.append((0x21, 0x02EF + room_index, palette_index))
+
+        m = regex.match(r"ZZ_indoor_([0-9a-f]+)_([0-9a-f]+).png", data.tileset_image)
+        if m and room_index >= 0x100:
+            tileset_index, re.animation_id = [int(v, 16) for v in m.groups()]
+            side_table_data.append((0x20, 0x2eB3 + room_index - 0x100, tileset_index))
+
+        m = regex.match(r"ZZ_sidescroll_([0-9a-f]+).png", data.tileset_image)
+        if m and room_index >= 0x100:
+            re.animation_id = [int(v, 16) for v in m.groups()][0]
+
+        if room_index < 0x100 and "MUSIC" in data.properties:
+            side_table_data.append((0x02, room_index, int(data.properties["MUSIC"], 16)))
+
+    entities_raw = bytes(re.getEntitiesRaw()) if isinstance(room_index, int) else None
+    overlay = bytes(re.overlay) if re.overlay is not None else None
+    return bytes(re.getObjectsRaw()), entities_raw, overlay, side_table_data, warp_count
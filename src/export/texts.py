@@ -1,6 +1,7 @@
 import configparser
 
 import utils
+from export.manifest import Manifest
 
 
 def _decodeText(text_data):
@@ -26,7 +27,13 @@ def _decodeText(text_data):
     return text, ask
 
 
-def exportTexts(rom, filename):
+def exportTexts(rom, filename, *, manifest=None):
+    if manifest is not None:
+        digest = Manifest.hashSources(*rom.texts)
+        current = manifest.isCurrent(filename, digest)
+        manifest.update(filename, digest)
+        if current:
+            return
     cp = configparser.ConfigParser()
     for index, text_data in enumerate(rom.texts):
         if isinstance(text_data, int):
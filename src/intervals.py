@@ -0,0 +1,189 @@
+import bisect
+
+
+class OwnerMap:
+    """
+        Tracks which owner last claimed each byte of an address range.
+        Claimed areas are kept as sorted, non-overlapping segments, so finding the owner of an address is a binary search.
+    """
+    def __init__(self):
+        self.__starts = []
+        self.__ends = []
+        self.__owners = []
+
+    def claim(self, start, end, owner):
+        """
+            Claim start-end for owner. Returns a list of (start, end, other_owner) for each area that
+            was already claimed by a different owner.
+        """
+        overlaps = []
+        first = bisect.bisect_right(self.__ends, start)
+        last = first
+        while last < len(self.__starts) and self.__starts[last] < end:
+            if self.__owners[last] != owner:
+                overlaps.append((max(self.__starts[last], start), min(self.__ends[last], end), self.__owners[last]))
+            last += 1
+
+        starts = [start]
+        ends = [end]
+        owners = [owner]
+        if first < last:
+            # Keep the parts of the partially overlapped segments at both edges.
+            if self.__starts[first] < start:
+                starts.insert(0, self.__starts[first])
+                ends.insert(0, start)
+                owners.insert(0, self.__owners[first])
+            if self.__ends[last - 1] > end:
+                starts.append(end)
+                ends.append(self.__ends[last - 1])
+                owners.append(self.__owners[last - 1])
+        self.__starts[first:last] = starts
+        self.__ends[first:last] = ends
+        self.__owners[first:last] = owners
+        return overlaps
+
+    def owner(self, addr):
+        idx = bisect.bisect_right(self.__starts, addr) - 1
+        if idx >= 0 and addr < self.__ends[idx]:
+            return self.__owners[idx]
+        return None
+
+    def segments(self):
+        return list(zip(self.__starts, self.__ends, self.__owners))
+
+
+class FreeList:
+    """
+        Free space per bank, kept as sorted lists of non-overlapping blocks.
+        Blocks are merged when they overlap or when the gap between them is at most merge_gap bytes.
+        A size ordered index of the blocks makes best fit allocation a binary search.
+    """
+    def __init__(self, *, merge_gap=0):
+        self.__merge_gap = merge_gap
+        self.__starts = {}
+        self.__ends = {}
+        self.__sizes = {}
+
+    def copy(self):
+        result = FreeList(merge_gap=self.__merge_gap)
+        for bank in self.__starts:
+            result.__starts[bank] = list(self.__starts[bank])
+            result.__ends[bank] = list(self.__ends[bank])
+            result.__sizes[bank] = list(self.__sizes[bank])
+        return result
+
+    def banks(self):
+        return sorted(self.__starts.keys())
+
+    def add(self, bank, start, end):
+        if start >= end:
+            return
+        if bank not in self.__starts:
+            self.__starts[bank] = []
+            self.__ends[bank] = []
+            self.__sizes[bank] = []
+        starts = self.__starts[bank]
+        ends = self.__ends[bank]
+        # Find all blocks that overlap or are close enough to merge with this one.
+        first = bisect.bisect_left(ends, start - self.__merge_gap)
+        last = first
+        while last < len(starts) and starts[last] <= end + self.__merge_gap:
+            start = min(start, starts[last])
+            end = max(end, ends[last])
+            self.__removeSize(bank, starts[last], ends[last])
+            last += 1
+        starts[first:last] = [start]
+        ends[first:last] = [end]
+        bisect.insort(self.__sizes[bank], (end - start, start))
+
+    def claim(self, bank, start, end):
+        """
+            Remove start-end from the free space, it does not need to be free.
+        """
+        if bank not in self.__starts or start >= end:
+            return
+        starts = self.__starts[bank]
+        ends = self.__ends[bank]
+        first = bisect.bisect_right(ends, start)
+        last = first
+        new_starts = []
+        new_ends = []
+        while last < len(starts) and starts[last] < end:
+            self.__removeSize(bank, starts[last], ends[last])
+            if starts[last] < start:
+                new_starts.append(starts[last])
+                new_ends.append(start)
+            if ends[last] > end:
+                new_starts.append(end)
+                new_ends.append(ends[last])
+            last += 1
+        starts[first:last] = new_starts
+        ends[first:last] = new_ends
+        for block_start, block_end in zip(new_starts, new_ends):
+            bisect.insort(self.__sizes[bank], (block_end - block_start, block_start))
+
+    def allocate(self, size, bank, *, best_fit=False, align=1):
+        """
+            Allocate size bytes in the given bank, returns the start address or None if there is no block that fits.
+            By default this takes the first block in address order, with best_fit the smallest block that fits.
+        """
+        if bank not in self.__starts:
+            return None
+        sizes = self.__sizes[bank]
+        if not sizes or sizes[-1][0] < size:
+            return None
+        if best_fit:
+            candidates = (start for _, start in sizes[bisect.bisect_left(sizes, (size, -1)):])
+        else:
+            candidates = iter(self.__starts[bank])
+        for start in candidates:
+            idx = bisect.bisect_left(self.__starts[bank], start)
+            end = self.__ends[bank][idx]
+            addr = start + (-start % align)
+            if addr + size <= end:
+                self.claim(bank, addr, addr + size)
+                return addr
+        return None
+
+    def isFree(self, bank, start, end):
+        if bank not in self.__starts:
+            return False
+        idx = bisect.bisect_right(self.__starts[bank], start) - 1
+        return idx >= 0 and end <= self.__ends[bank][idx]
+
+    def blocks(self, bank=None):
+        """
+            Returns the free blocks as a list of {"bank", "start", "end"} dicts, sorted by bank and address.
+        """
+        result = []
+        for b in self.banks():
+            if bank is None or b == bank:
+                for start, end in zip(self.__starts[b], self.__ends[b]):
+                    result.append({"bank": b, "start": start, "end": end})
+        return result
+
+    def total(self, bank=None):
+        return sum(size for b in self.banks() if bank is None or b == bank for size, _ in self.__sizes[b])
+
+    def largest(self, bank=None):
+        return max([self.__sizes[b][-1][0] for b in self.banks() if (bank is None or b == bank) and self.__sizes[b]], default=0)
+
+    def fragments(self, bank=None):
+        return sum(len(self.__starts[b]) for b in self.banks() if bank is None or b == bank)
+
+    def report(self, bank=None):
+        """
+            Fragmentation report, fragmentation is the part of the free space that is not in the largest block.
+        """
+        total = self.total(bank)
+        largest = self.largest(bank)
+        return {
+            "free": total,
+            "largest": largest,
+            "fragments": self.fragments(bank),
+            "fragmentation": round(1.0 - largest / total, 3) if total else 0.0,
+        }
+
+    def __removeSize(self, bank, start, end):
+        sizes = self.__sizes[bank]
+        del sizes[bisect.bisect_left(sizes, (end - start, start))]
@@ -36,22 +36,37 @@ def findRLESequences(data, min_size=20):
     return rle
 
 
+def findDifference(old, new, start, end):
+    # Find the first byte between start and end that differs, skipping over equal blocks without a python loop.
+    while start < end:
+        block_end = min(start + 0x100, end)
+        if old[start:block_end] != new[start:block_end]:
+            while old[start] == new[start]:
+                start += 1
+            return start
+        start = block_end
+    return end
+
+
 # Sloppy IPS patch generator
-def makePatch(old, new, patch):
-    old = open(old, "rb").read()
-    new = open(new, "rb").read()
-    start = 0
+# old and new can be filenames or the rom data itself.
+# ranges is an optional list of (start, end) areas that can contain changes, see ROM.getDirtyRanges
+def makePatch(old, new, patch, *, ranges=None):
+    if isinstance(old, str):
+        old = open(old, "rb").read()
+    if isinstance(new, str):
+        new = open(new, "rb").read()
+    if ranges is None:
+        ranges = [(0, len(new))]
     patches = []
-    while start < len(new):
-        if old[start] != new[start]:
+    for range_start, range_end in ranges:
+        start = findDifference(old, new, range_start, range_end)
+        while start < range_end:
             end = start
-            while end < len(new) and old[end] != new[end]:
+            while end < range_end and old[end] != new[end]:
                 end += 1
-            size = end - start
-            patches.append(Patch(start, size))
-            start = end
-        else:
-            start += 1
+            patches.append(Patch(start, end - start))
+            start = findDifference(old, new, end, range_end)
 
     # Merge patches that are close enough to gether to save record space
     idx = 0
@@ -1,12 +1,19 @@
-# Ensure that pillow is installed before we do anything else.
+# Ensure that pillow and numpy are installed before we do anything else.
 try:
     import PIL.Image
 except ImportError:
     import subprocess
     import sys
     subprocess.check_call([sys.executable, "-m", "pip", "install", "Pillow"])
+try:
+    import numpy
+except ImportError:
+    import subprocess
+    import sys
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "numpy"])
 
 import argparse
+import json
 import sys
 import os
 import importlib.util
@@ -15,6 +22,8 @@ import importlib.machinery
 import export.texts
 import export.rooms
 import export.map
+import export.manifest
+import export.buildCache
 import patches.chest
 import patches.droppedKey
 import patches.heartPiece
@@ -37,19 +46,25 @@ import assembler
 import roomEditor
 import backgroundEditor
 import ips
+import romCache
+import timing
 
 from romTables import ROMWithTables
+from pointerTable import PACKING_MODES
 
 
-def exportRomData(rom, path):
+def exportRomData(rom, path, *, jobs=1):
     print("Exporting data")
-    export.texts.exportTexts(rom, os.path.join(path, "dialogs.txt"))
-    export.rooms.exportRooms(rom, os.path.join(path, "rooms"))
-    export.map.exportMap(rom, os.path.join(path, "map.png"))
-
-def importRomData(rom, path):
+    # Only files of which the source data in the rom changed since the last export are written.
+    manifest = export.manifest.Manifest(path)
+    export.texts.exportTexts(rom, os.path.join(path, "dialogs.txt"), manifest=manifest)
+    export.rooms.exportRooms(rom, os.path.join(path, "rooms"), jobs=jobs, manifest=manifest)
+    export.map.exportMap(rom, os.path.join(path, "map.png"), manifest=manifest)
+    manifest.save()
+
+def importRomData(rom, path, *, build_cache=None):
     print("Importing data")
-    export.rooms.importRooms(rom, os.path.join(path, "rooms"))
+    export.rooms.importRooms(rom, os.path.join(path, "rooms"), cache=build_cache)
     export.texts.importTexts(rom, os.path.join(path, "dialogs.txt"))
     export.map.importMap(rom, os.path.join(path, "map.png"))
 
@@ -61,6 +76,50 @@ def importRomData(rom, path):
         module.apply(rom)
 
 
+def applyEarlyPatches(rom):
+    # Apply early patches that modify things that we need before export.
+    # These only depend on the input rom, so a generator building many roms can apply them once and fork the result.
+    patches.chest.fixChests(rom)
+    patches.droppedKey.fixDroppedKey(rom)
+    patches.heartPiece.fixHeartPiece(rom)
+    patches.health.upgradeHealthContainers(rom)
+    patches.seashell.fixSeashell(rom)
+    patches.seashell.upgradeMansion(rom)
+    patches.overworld.patchOverworldTilesets(rom)
+    patches.owl.removeOwlEvents(rom)
+    patches.bank3e.addBank3E(rom, b'')
+    patches.bank3f.addBank3F(rom)
+    patches.core.bugfixBossroomTopPush(rom)
+    patches.core.bugfixWrittingWrongRoomStatus(rom)
+    patches.core.fixEggDeathClearingItems(rom)
+    patches.softlock.allowRaftGameWithoutFlippers(rom)
+    patches.aesthetics.noSwordMusic(rom)
+    patches.aesthetics.allowColorDungeonSpritesEverywhere(rom)
+    patches.inventory.moreSlots(rom)
+    patches.witch.updateWitch(rom)
+    patches.instrument.fixInstruments(rom)
+    patches.goldenLeaf.fixGoldenLeaf(rom)
+    patches.tarin.updateTarin(rom)
+    patches.shop.fixShop(rom)
+
+    # We need to fix up a few vanilla room warp orders, as updating these rooms changes the order of the warps
+    re = roomEditor.RoomEditor(rom, 0x0A1)
+    re.objects = [obj for obj in re.objects if not isinstance(obj, roomEditor.ObjectWarp)] + list(reversed(re.getWarps()))
+    re.store(rom)
+    # TODO: room 0x01D
+
+
+def printTimingReport(rom, loop_bound):
+    for report in timing.frameReport(rom, default_loop_bound=loop_bound):
+        worst = "unbounded" if report["worst"] is None else "%d" % (report["worst"])
+        print("%-12s %04x: best %d, worst %s of %d M-cycles per frame%s" % (
+            report["name"], report["entry"], report["best"], worst, timing.FRAME_CYCLES, "" if report["fits"] else " (NOT PROVEN TO FIT)"))
+        if report["unknown_calls"]:
+            print("  unknown calls: %s" % (", ".join("%04x" % (addr) for addr in report["unknown_calls"])))
+        if report["unbounded_loops"]:
+            print("  loops without bound: %s" % (", ".join("%04x" % (addr) for addr in report["unbounded_loops"])))
+
+
 def main(argv):
     parser = argparse.ArgumentParser(description='Toolbox!')
     parser.add_argument('input_filename', metavar='input rom', type=str,
@@ -69,7 +128,24 @@ def main(argv):
         help="Path to use to for output or input data.")
     parser.add_argument('--export', dest="export", action="store_true")
     parser.add_argument('--build', dest="build", type=str)
+    parser.add_argument('--jobs', dest="jobs", type=int, default=1,
+        help="Number of processes to export the rooms with.")
+    parser.add_argument('--no-cache', dest="cache", action="store_false",
+        help="Do not use or update the cached early patched rom and encoded rooms.")
+    parser.add_argument('--check-conflicts', dest="check_conflicts", action="store_true",
+        help="Report patches from different functions that write to the same bytes.")
+    parser.add_argument('--packing', dest="packing", choices=PACKING_MODES, default="first_fit",
+        help="How to place the rooms, entities and texts in the free rom space, best_fit or decreasing pack tighter than first_fit.")
+    parser.add_argument('--space-report', dest="space_report", type=str, nargs="?", const="-",
+        help="After building, print the free space of all rom tables as JSON, or write it to the given file.")
+    parser.add_argument('--timing-report', dest="timing_report", action="store_true",
+        help="After building, print the best and worst case M-cycles of the code that runs every frame.")
+    parser.add_argument('--loop-bound', dest="loop_bound", type=int,
+        help="Maximum number of iterations of each loop for the timing report, without it loops have no worst case.")
     args = parser.parse_args(argv)
+    if args.check_conflicts:
+        # The cached rom does not know which function applied which patch.
+        args.cache = False
 
     os.makedirs(args.path, exist_ok=True)
 
@@ -97,45 +173,46 @@ def main(argv):
     assembler.const("wZolSpawnCount", 0xDE10)
     assembler.const("wCuccoSpawnCount", 0xDE11)
 
-    rom = ROMWithTables(args.input_filename)
-    if not patches.bank3e.hasBank3E(rom):
-        # Apply early patches that modify things that we need before export
-        patches.chest.fixChests(rom)
-        patches.droppedKey.fixDroppedKey(rom)
-        patches.heartPiece.fixHeartPiece(rom)
-        patches.health.upgradeHealthContainers(rom)
-        patches.seashell.fixSeashell(rom)
-        patches.seashell.upgradeMansion(rom)
-        patches.overworld.patchOverworldTilesets(rom)
-        patches.owl.removeOwlEvents(rom)
-        patches.bank3e.addBank3E(rom, b'')
-        patches.bank3f.addBank3F(rom)
-        patches.core.bugfixBossroomTopPush(rom)
-        patches.core.bugfixWrittingWrongRoomStatus(rom)
-        patches.core.fixEggDeathClearingItems(rom)
-        patches.softlock.allowRaftGameWithoutFlippers(rom)
-        patches.aesthetics.noSwordMusic(rom)
-        patches.aesthetics.allowColorDungeonSpritesEverywhere(rom)
-        patches.inventory.moreSlots(rom)
-        patches.witch.updateWitch(rom)
-        patches.instrument.fixInstruments(rom)
-        patches.goldenLeaf.fixGoldenLeaf(rom)
-        patches.tarin.updateTarin(rom)
-        patches.shop.fixShop(rom)
-
-        # We need to fix up a few vanilla room warp orders, as updating these rooms changes the order of the warps
-        re = roomEditor.RoomEditor(rom, 0x0A1)
-        re.objects = [obj for obj in re.objects if not isinstance(obj, roomEditor.ObjectWarp)] + list(reversed(re.getWarps()))
-        re.store(rom)
-        # TODO: room 0x01D
+    rom = None
+    if args.cache:
+        cache_path = os.path.join(args.path, ".cache")
+        cache_key = romCache.cacheKey(args.input_filename)
+        rom = romCache.load(cache_path, cache_key)
+        assembler.enableDiskCache(os.path.join(cache_path, "asm.cache"))
+    if rom is None:
+        rom = ROMWithTables(args.input_filename)
+        rom.startJournal()
+        if args.check_conflicts:
+            rom.startConflictCheck()
+        if not patches.bank3e.hasBank3E(rom):
+            applyEarlyPatches(rom)
+            if args.cache:
+                romCache.store(cache_path, cache_key, rom)
 
     if args.export:
-        exportRomData(rom, args.path)
+        exportRomData(rom, args.path, jobs=args.jobs)
     if args.build:
-        importRomData(rom, args.path)
+        # Rooms of which the json did not change since the last build are taken from the build cache instead of encoded.
+        build_cache = None
+        if args.cache:
+            build_cache = export.buildCache.BuildCache(os.path.join(cache_path, "rooms.cache"), cache_key)
+        importRomData(rom, args.path, build_cache=build_cache)
+        if build_cache is not None:
+            build_cache.save()
         patches.aesthetics.updateSpriteData(rom)
-        rom.save(args.build)
-        ips.makePatch(args.input_filename, args.build, os.path.splitext(args.build)[0] + ".ips")
+        rom.save(args.build, packing=args.packing)
+        ips.makePatch(rom.original, rom.data, os.path.splitext(args.build)[0] + ".ips", ranges=rom.getDirtyRanges())
+        if args.space_report:
+            report = rom.spaceReport()
+            if args.space_report == "-":
+                print(json.dumps(report, indent=2))
+            else:
+                json.dump(report, open(args.space_report, "wt"), indent=2)
+        if args.timing_report:
+            printTimingReport(rom, args.loop_bound)
+    if args.check_conflicts:
+        print("%d patch conflicts found" % (len(rom.patch_conflicts)))
+    assembler.saveDiskCache()
 
 
 if __name__ == "__main__":
@@ -7,30 +7,13 @@ import os
 
 def imageTo2bpp(filename):
     import PIL.Image
+    import tileCodec
     img = PIL.Image.open(filename)
     assert (img.size[0] % 8) == 0
     tileheight = 8 if img.size[1] == 8 else 16
     assert (img.size[1] % tileheight) == 0
 
-    cols = img.size[0] // 8
-    rows = img.size[1] // tileheight
-    result = bytearray(rows * cols * tileheight * 2)
-    index = 0
-    for ty in range(rows):
-        for tx in range(cols):
-            for y in range(tileheight):
-                a = 0
-                b = 0
-                for x in range(8):
-                    c = img.getpixel((tx * 8 + x, ty * 16 + y))
-                    if c & 1:
-                        a |= 0x80 >> x
-                    if c & 2:
-                        b |= 0x80 >> x
-                result[index] = a
-                result[index+1] = b
-                index += 2
-    return result
+    return bytearray(tileCodec.encode(tileCodec.split(tileCodec.fromImage(img), tileheight)))
 
 
 def updateGraphics(rom, bank, offset, data):
@@ -68,6 +51,7 @@ def gfxMod(rom, filename):
 
 def createGfxImage(rom, filename):
     import PIL.Image
+    import tileCodec
     bank_count = 8
     img = PIL.Image.new("P", (32 * 8, 32 * 8 * bank_count))
     img.putpalette((
@@ -77,19 +61,9 @@ def createGfxImage(rom, filename):
         255, 255, 255,
     ))
     for bank_nr in range(bank_count):
-        bank = rom.banks[0x2C + bank_nr]
-        for tx in range(32):
-            for ty in range(16):
-                for y in range(16):
-                    a = bank[tx * 32 + ty * 32 * 32 + y * 2]
-                    b = bank[tx * 32 + ty * 32 * 32 + y * 2 + 1]
-                    for x in range(8):
-                        c = 0
-                        if a & (0x80 >> x):
-                            c |= 1
-                        if b & (0x80 >> x):
-                            c |= 2
-                        img.putpixel((tx*8+x, bank_nr * 32 * 8 + ty*16+y), c)
+        # Each bank is 16 rows of 32 tiles of 8x16 pixels.
+        tiles = tileCodec.decode(rom.banks[0x2C + bank_nr]).reshape(-1, 16, 8)
+        img.paste(tileCodec.toImage(tileCodec.arrange(tiles, 32)), (0, bank_nr * 32 * 8))
     img.save(filename)
 
 
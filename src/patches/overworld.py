@@ -82,7 +82,7 @@ def createDungeonOnlyOverworld(rom):
 
 
 def exportOverworld(rom):
-    import PIL.Image
+    import tileCodec
 
     path = os.path.dirname(__file__)
     for room_index in list(range(0x100)) + ["Alt06", "Alt0E", "Alt1B", "Alt2B", "Alt79", "Alt8C"]:
@@ -174,34 +174,7 @@ def exportOverworld(rom):
                 b = ((pal >> 10) & 0x1F) << 3
                 palette += [r, g, b]
 
-            img = PIL.Image.new("P", (16*16, 16*16))
-            img.putpalette(palette)
-            def drawTile(x, y, index, attr):
-                for py in range(8):
-                    a = tilemap[index * 16 + py * 2]
-                    b = tilemap[index * 16 + py * 2 + 1]
-                    if attr & 0x40:
-                        a = tilemap[index * 16 + 14 - py * 2]
-                        b = tilemap[index * 16 + 15 - py * 2]
-                    for px in range(8):
-                        bit = 0x80 >> px
-                        if attr & 0x20:
-                            bit = 0x01 << px
-                        c = (attr & 7) << 2
-                        if a & bit:
-                            c |= 1
-                        if b & bit:
-                            c |= 2
-                        img.putpixel((x+px, y+py), c)
-            for x in range(16):
-                for y in range(16):
-                    idx = x+y*16
-                    metatiles = metatile_info[idx*4:idx*4+4]
-                    attrtiles = attrtile_info[idx*4:idx*4+4]
-                    drawTile(x * 16 + 0, y * 16 + 0, metatiles[0], attrtiles[0])
-                    drawTile(x * 16 + 8, y * 16 + 0, metatiles[1], attrtiles[1])
-                    drawTile(x * 16 + 0, y * 16 + 8, metatiles[2], attrtiles[2])
-                    drawTile(x * 16 + 8, y * 16 + 8, metatiles[3], attrtiles[3])
+            img = tileCodec.toImage(tileCodec.renderMetatiles(tilemap, metatile_info, attrtile_info), palette)
             img.save("%s/overworld/export/%s" % (path, image_filename))
 
     world = {
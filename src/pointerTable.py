@@ -1,6 +1,12 @@
 import copy
 import struct
 
+from intervals import FreeList
+from suffixAutomaton import PlacedData
+
+
+PACKING_MODES = ("first_fit", "best_fit", "decreasing")
+
 
 class PointerTable:
     END_OF_DATA = (0xff, )
@@ -19,7 +25,17 @@ class PointerTable:
         self.__data = []
         self.__alt_data = {}
         self.__banks = []
-        self.__storage = []
+        # Location of each entry in the rom at the last load or store, None for entries that are not stored in a bank.
+        self.__pointers = []
+        self.__alt_pointers = {}
+        # Indices and alt keys of the entries that have been modified since the last load or store.
+        self.__dirty = set()
+        # Data storage areas, gaps of a single byte between data blocks are claimed as well.
+        self.__storage = FreeList(merge_gap=1)
+        # Comparison against first fit placement from the last store with a different packing, None otherwise.
+        self.packing_report = None
+        # Set when the data is shared with a forked table, and needs to be copied before modifying it.
+        self.__shared = False
 
         count = info["count"]
         addr = info["pointers_addr"]
@@ -40,6 +56,7 @@ class PointerTable:
             for key, (bank, addr) in self.__info["alt_pointers"].items():
                 pointer = struct.unpack("<H", rom.banks[bank][addr:addr+2])[0]
                 assert 0x4000 <= pointer < 0x8000
+                self.__alt_pointers[key] = pointer & 0x3FFF
                 self.__alt_data[key] = self._readData(rom, self.__info["data_bank"], pointer & 0x3FFF)
 
         for n in range(count):
@@ -48,25 +65,21 @@ class PointerTable:
             if 0x4000 <= pointer < 0x8000:
                 pointer &= 0x3fff
                 self.__data.append(self._readData(rom, bank, pointer))
+                self.__pointers.append(pointer)
             else:
                 self.__data.append(pointer)
+                self.__pointers.append(None)
             self.__banks.append(bank)
 
-        while self.__mergeStorage():
-            pass
-        self.__storage.sort(key=lambda n: n["start"])
         if "claim_storage_gaps" in info and info["claim_storage_gaps"]:
-            self.__storage = [{"bank": self.__storage[0]["bank"], "start": self.__storage[0]["start"], "end": self.__storage[-1]["end"]}]
+            blocks = self.__storage.blocks()
+            self.__storage.add(blocks[0]["bank"], blocks[0]["start"], blocks[-1]["end"])
         if "expand_to_end_of_bank" in info and info["expand_to_end_of_bank"]:
-            for st in self.__storage:
-                expand = True
-                for st2 in self.__storage:
-                    if st["bank"] == st2["bank"] and st["end"] < st2["end"]:
-                        expand = False
-                if expand:
-                    st["end"] = 0x4000
-
-        # for s in sorted(self.__storage, key=lambda s: (s["bank"], s["start"])):
+            for bank in self.__storage.banks():
+                last = self.__storage.blocks(bank)[-1]
+                self.__storage.add(bank, last["start"], 0x4000)
+
+        # for s in self.__storage.blocks():
         #     print(self.__class__.__name__, s)
 
     def __contains__(self, item):
@@ -75,6 +88,11 @@ class PointerTable:
         return 0 <= item < len(self.__data)
 
     def __setitem__(self, item, value):
+        if self.__shared:
+            self.__data = list(self.__data)
+            self.__alt_data = dict(self.__alt_data)
+            self.__shared = False
+        self.__dirty.add(item)
         if isinstance(item, str):
             self.__alt_data[item] = value
         else:
@@ -88,72 +106,259 @@ class PointerTable:
     def __len__(self):
         return len(self.__data)
 
-    def store(self, rom):
-        storage = copy.deepcopy(self.__storage)
+    def fork(self):
+        """
+            Create a copy of this table which shares the entries with this table.
+            Entries are never modified in place, so the entry lists only need to be copied on the first write.
+        """
+        result = copy.copy(self)
+        result.__info = dict(self.__info)
+        result.__banks = list(self.__banks)
+        result.__pointers = list(self.__pointers)
+        result.__alt_pointers = dict(self.__alt_pointers)
+        result.__dirty = set(self.__dirty)
+        result.__storage = self.__storage.copy()
+        self.__shared = True
+        result.__shared = True
+        return result
 
-        pointers_bank = self.__info["pointers_bank"]
-        pointers_addr = self.__info["pointers_addr"]
+    def store(self, rom, *, packing="first_fit"):
+        """
+            Write the entries back into the rom and return the storage blocks that are left over.
+            packing selects how entries are placed in the free storage:
+                "first_fit": in table order, in the first block they fit in.
+                "best_fit": in table order, in the smallest block they fit in.
+                "decreasing": largest entries first, each in the smallest block it fits in.
+            With first fit, only the entries that were modified since the last load or store are written,
+            in their old location when they still fit there. All other entries keep their bytes and pointers.
+            Everything is placed again when the modified entries do not fit around the others.
+            Tables with a bank per entry can list overflow_banks in their info, entries that do not fit in their own bank
+            are then placed in the first of those banks with room for them, and the bank table is updated.
+            Tables that index into fixed size data (data_addr) are always fully placed with first fit.
+            With a packing other than first fit, packing_report compares the result against first fit.
+        """
+        assert packing in PACKING_MODES, "Unknown packing: %s" % (packing)
+        self.packing_report = None
+        if "data_addr" in self.__info:
+            packing = "first_fit"
+        elif packing == "first_fit":
+            storage = self.__storeModified(rom)
+            if storage is not None:
+                return storage.blocks()
 
-        done = {}
-        for st in storage:
-            done[st["bank"]] = {}
-        for key, (ptr_bank, ptr_addr) in self.__info.get("alt_pointers", {}).items():
-            s = bytes(self.__alt_data[key])
-            bank = self.__info["data_bank"]
-            my_storage = None
-            for st in storage:
-                if st["end"] - st["start"] >= len(s) and st["bank"] == bank:
-                    my_storage = st
-                    break
-            assert my_storage is not None, "Not enough room in storage... %s" % (storage)
+        entries = self.__entries()
+        storage = self.__storage.copy()
+        placements = self.__place(entries, storage, packing)
 
-            pointer = my_storage["start"]
-            my_storage["start"] = pointer + len(s)
-            rom.banks[bank][pointer:pointer + len(s)] = s
+        if packing != "first_fit":
+            first_fit_storage = self.__storage.copy()
+            try:
+                self.__place(entries, first_fit_storage, "first_fit")
+            except AssertionError:
+                first_fit_storage = None
+            self.packing_report = {
+                "packing": packing,
+                "used": self.__storage.total() - storage.total(),
+                "largest_free": storage.largest(),
+                "first_fit_used": None if first_fit_storage is None else self.__storage.total() - first_fit_storage.total(),
+                "first_fit_largest_free": None if first_fit_storage is None else first_fit_storage.largest(),
+            }
+            if first_fit_storage is not None:
+                self.packing_report["recovered"] = self.packing_report["first_fit_used"] - self.packing_report["used"]
 
-            rom.banks[ptr_bank][ptr_addr] = pointer & 0xFF
-            rom.banks[ptr_bank][ptr_addr + 1] = (pointer >> 8) | 0x40
+        written = set()
+        for (_, s, _), (bank, pointer) in zip(entries, placements):
+            if (bank, pointer, s) not in written:
+                written.add((bank, pointer, s))
+                self.__writeData(rom, bank, pointer, s)
 
+        placements = iter(placements)
+        for key in self.__info.get("alt_pointers", {}):
+            self.__writeAltPointer(rom, key, next(placements)[1])
         for n, s in enumerate(self.__data):
             if isinstance(s, int):
-                pointer = s
+                self.__writePointer(rom, n, s)
             else:
-                s = bytes(s)
-                bank = self.__banks[n]
-                if s in done[bank]:
-                    pointer = done[bank][s]
-                    assert rom.banks[bank][pointer:pointer+len(s)] == s
-                else:
-                    my_storage = None
-                    for st in storage:
-                        if st["end"] - st["start"] >= len(s) and st["bank"] == bank:
-                            my_storage = st
-                            break
-                    assert my_storage is not None, "Not enough room in storage... %d/%d %s" % (n, len(self.__data), storage)
-
-                    pointer = my_storage["start"]
-                    my_storage["start"] = pointer + len(s)
-                    rom.banks[bank][pointer:pointer+len(s)] = s
-
-                    if "data_size" not in self.__info:
-                        # aggressive de-duplication.
-                        for skip in range(len(s)):
-                            done[bank][s[skip:]] = pointer + skip
-                    done[bank][s] = pointer
-
-            if "data_addr" in self.__info:
-                offset = pointer - self.__info["data_addr"]
-                if "data_size" in self.__info:
-                    assert offset % self.__info["data_size"] == 0
-                    offset //= self.__info["data_size"]
-                rom.banks[pointers_bank][pointers_addr + n] = offset
+                bank, pointer = next(placements)
+                if bank != self.__banks[n]:
+                    self.__writeBank(rom, n, bank)
+                self.__writePointer(rom, n, pointer)
+        self.__dirty.clear()
+
+        # print(self.__class__.__name__, "Space left:", storage.report())
+        return storage.blocks()
+
+    def __storeModified(self, rom):
+        # Place and write only the modified entries, the unchanged entries keep their storage.
+        # Returns the storage that is left over, or None if the modified entries do not fit.
+        storage = self.__storage.copy()
+        for key, pointer in self.__alt_pointers.items():
+            if key not in self.__dirty:
+                storage.claim(self.__info["data_bank"], pointer, pointer + len(self.__alt_data[key]))
+        for n, pointer in enumerate(self.__pointers):
+            if n not in self.__dirty and pointer is not None:
+                storage.claim(self.__banks[n], pointer, pointer + len(self.__data[n]))
+
+        alt_pointers = {}
+        pointers = {}
+        for key in self.__alt_pointers:
+            if key in self.__dirty:
+                alt_pointers[key] = self.__allocateModified(storage, self.__info["data_bank"], self.__alt_pointers[key], self.__alt_data[key])
+                if alt_pointers[key] is None:
+                    return None
+        for n in sorted(item for item in self.__dirty if not isinstance(item, str)):
+            if isinstance(self.__data[n], int):
+                pointers[n] = self.__data[n]
             else:
-                rom.banks[pointers_bank][pointers_addr+n*2] = pointer & 0xff
-                rom.banks[pointers_bank][pointers_addr+n*2+1] = ((pointer >> 8) & 0xff) | 0x40
+                pointers[n] = self.__allocateModified(storage, self.__banks[n], self.__pointers[n], self.__data[n])
+                if pointers[n] is None:
+                    return None
 
-        space_left = sum(map(lambda n: n["end"] - n["start"], storage))
+        for key, pointer in alt_pointers.items():
+            self.__writeData(rom, self.__info["data_bank"], pointer, bytes(self.__alt_data[key]))
+            self.__writeAltPointer(rom, key, pointer)
+        for n, pointer in pointers.items():
+            if not isinstance(self.__data[n], int):
+                self.__writeData(rom, self.__banks[n], pointer, bytes(self.__data[n]))
+            self.__writePointer(rom, n, pointer)
+        self.__dirty.clear()
         return storage
-        # print(self.__class__.__name__, "Space left:", space_left)
+
+    @staticmethod
+    def __allocateModified(storage, bank, old_pointer, s):
+        if old_pointer is not None and len(s) > 0 and storage.isFree(bank, old_pointer, old_pointer + len(s)):
+            storage.claim(bank, old_pointer, old_pointer + len(s))
+            return old_pointer
+        return storage.allocate(len(s), bank)
+
+    def __writeData(self, rom, bank, pointer, s):
+        if rom.banks[bank][pointer:pointer+len(s)] != s:
+            rom.banks[bank][pointer:pointer+len(s)] = s
+
+    def __writeAltPointer(self, rom, key, pointer):
+        ptr_bank, ptr_addr = self.__info["alt_pointers"][key]
+        rom.banks[ptr_bank][ptr_addr] = pointer & 0xFF
+        rom.banks[ptr_bank][ptr_addr + 1] = (pointer >> 8) | 0x40
+        self.__alt_pointers[key] = pointer
+
+    def __writeBank(self, rom, n, bank):
+        # The upper bits of the bank table are not part of the bank number, so those are kept.
+        banks_bank = rom.banks[self.__info["banks_bank"]]
+        addr = self.__info["banks_addr"] + n
+        banks_bank[addr] = (banks_bank[addr] & 0xC0) | bank
+        self.__banks[n] = bank
+
+    def __writePointer(self, rom, n, pointer):
+        pointers_bank = self.__info["pointers_bank"]
+        pointers_addr = self.__info["pointers_addr"]
+        if "data_addr" in self.__info:
+            offset = pointer - self.__info["data_addr"]
+            if "data_size" in self.__info:
+                assert offset % self.__info["data_size"] == 0
+                offset //= self.__info["data_size"]
+            rom.banks[pointers_bank][pointers_addr + n] = offset
+        else:
+            rom.banks[pointers_bank][pointers_addr+n*2] = pointer & 0xff
+            rom.banks[pointers_bank][pointers_addr+n*2+1] = ((pointer >> 8) & 0xff) | 0x40
+        self.__pointers[n] = None if isinstance(self.__data[n], int) else pointer
+
+    def spaceReport(self):
+        """
+            Report of the storage space of this table, with the entries as they were placed by the last load or store.
+            Returns a dict with the totals and a "banks" list with the same values for each bank:
+                capacity: size of the storage area.
+                used / free: bytes in use and bytes left over.
+                largest / fragments / fragmentation: largest free block, number of free blocks, and the part of the free space that is not in the largest block.
+                data_size: size of all entries together, dedup_saved: bytes saved by sharing data between entries.
+        """
+        free = self.__storage.copy()
+        data_size = {}
+        for bank in free.banks():
+            data_size[bank] = 0
+        placed = [(self.__info["data_bank"], pointer, self.__alt_data[key]) for key, pointer in self.__alt_pointers.items()]
+        placed += [(self.__banks[n], pointer, self.__data[n]) for n, pointer in enumerate(self.__pointers) if pointer is not None]
+        for bank, pointer, s in placed:
+            free.claim(bank, pointer, pointer + len(s))
+            if bank in data_size:
+                data_size[bank] += len(s)
+
+        def bankReport(bank):
+            capacity = self.__storage.total(bank)
+            result = {"capacity": capacity, "used": capacity - free.total(bank)}
+            result.update(free.report(bank))
+            result["data_size"] = sum(size for b, size in data_size.items() if bank is None or b == bank)
+            result["dedup_saved"] = max(0, result["data_size"] - result["used"])
+            return result
+
+        result = bankReport(None)
+        result["banks"] = []
+        for bank in free.banks():
+            result["banks"].append(dict(bank=bank, **bankReport(bank)))
+        return result
+
+    def __entries(self):
+        # List of (bank, data, dedup) for everything that needs to be placed in storage, alt data first.
+        # Alt data is never de-duplicated, so it keeps a location of its own.
+        result = []
+        for key in self.__info.get("alt_pointers", {}):
+            result.append((self.__info["data_bank"], bytes(self.__alt_data[key]), False))
+        for n, s in enumerate(self.__data):
+            if not isinstance(s, int):
+                result.append((self.__banks[n], bytes(s), True))
+        return result
+
+    def __place(self, entries, storage, packing):
+        # Allocate storage for each entry, returns the (bank, pointer) of each entry in the same order as the entries.
+        order = range(len(entries))
+        if packing == "decreasing":
+            # Placing the large entries first lets the small ones fill up the gaps left over,
+            # and lets the smaller entries be found inside the larger ones.
+            order = sorted(order, key=lambda idx: -len(entries[idx][1]))
+        best_fit = packing != "first_fit"
+        # Entries of tables with a bank per entry can overflow into these banks when their own bank is full.
+        overflow_banks = [bank for bank in self.__info.get("overflow_banks", []) if bank in storage.banks()]
+
+        # Exact duplicates for tables with fixed size data, the other tables search all data placed so far in the bank.
+        done = {}
+        placed = {}
+        for bank in storage.banks():
+            done[bank] = {}
+            placed[bank] = PlacedData()
+        result = [None] * len(entries)
+        for idx in order:
+            bank, s, dedup = entries[idx]
+            candidates = [bank]
+            if dedup and "banks_addr" in self.__info:
+                candidates += [other for other in overflow_banks if other != bank]
+            for bank in candidates:
+                pointer = self.__placeInBank(storage, bank, s, dedup, done, placed, best_fit)
+                if pointer is not None:
+                    break
+            assert pointer is not None, "Not enough room in storage... %d/%d %s" % (idx, len(entries), storage.blocks())
+            result[idx] = (bank, pointer)
+        return result
+
+    def __placeInBank(self, storage, bank, s, dedup, done, placed, best_fit):
+        if dedup and "data_size" in self.__info:
+            if s in done.get(bank, {}):
+                return done[bank][s]
+        elif dedup and bank in placed:
+            pointer = placed[bank].find(s)
+            if pointer is not None:
+                return pointer
+            # Place the entry so that its head re-uses the tail of data placed earlier, if the rest fits after it.
+            pointer, size = placed[bank].findOverlap(s, lambda start, end: storage.isFree(bank, start, end))
+            if pointer is not None:
+                storage.claim(bank, pointer + size, pointer + len(s))
+                placed[bank].add(pointer + size, s[size:])
+                return pointer
+        pointer = storage.allocate(len(s), bank, best_fit=best_fit)
+        if pointer is not None:
+            if "data_size" in self.__info:
+                done[bank][s] = pointer
+            else:
+                placed[bank].add(pointer, s)
+        return pointer
 
     def _readData(self, rom, bank_nr, pointer):
         bank = rom.banks[bank_nr]
@@ -168,40 +373,17 @@ class PointerTable:
         return bank[start:pointer]
 
     def _addStorage(self, bank, start, end):
-        for n, data in enumerate(self.__storage):
-            if data["bank"] == bank:
-                if data["start"] == end:
-                    data["start"] = start
-                    return
-                if data["end"] == start:
-                    data["end"] = end
-                    return
-                if data["start"] <= start and data["end"] >= end:
-                    return
-        self.__storage.append({"bank": bank, "start": start, "end": end})
-
-    def __mergeStorage(self):
-        for n in range(len(self.__storage)):
-            n_end = self.__storage[n]["end"]
-            n_start = self.__storage[n]["start"]
-            for m in range(len(self.__storage)):
-                if m == n or self.__storage[n]["bank"] != self.__storage[m]["bank"]:
-                    continue
-                m_end = self.__storage[m]["end"]
-                m_start = self.__storage[m]["start"]
-                if m_start - 1 <= n_end <= m_end:
-                    self.__storage[n]["start"] = min(self.__storage[n]["start"], self.__storage[m]["start"])
-                    self.__storage[n]["end"] = self.__storage[m]["end"]
-                    self.__storage.pop(m)
-                    return True
-        return False
+        self.__storage.add(bank, start, end)
+
+    def getStorage(self):
+        """
+            All storage areas of this table, both the used and the free parts.
+        """
+        return self.__storage.blocks()
 
     def addStorage(self, extra_storage):
         for data in extra_storage:
             self._addStorage(data["bank"], data["start"], data["end"])
-        while self.__mergeStorage():
-            pass
-        self.__storage.sort(key=lambda n: n["start"])
 
     def adjustDataStart(self, new_start):
         self.__info["data_addr"] = new_start
\ No newline at end of file
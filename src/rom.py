@@ -1,16 +1,236 @@
 import binascii
+import sys
+
+from intervals import OwnerMap, FreeList
 
 b2h = binascii.hexlify
 h2b = binascii.unhexlify
 
+BANK_SIZE = 0x4000
+BANK_COUNT = 0x40
+
+# Byte values that fill the unused space of the original rom.
+FREE_SPACE_FILL = (0x00, 0xFF)
+# (bank, start, end) areas inside banks that are known to be unused, these are registered when they are still empty.
+# Only areas that are checked to be unused belong here, empty looking bytes in graphics and data banks are often live data.
+KNOWN_FREE_SPACE = [
+    (0x19, 0x3F2B, 0x3F45),
+    (0x19, 0x3FE0, 0x3FFA),
+]
+
+
+class PatchMismatch(AssertionError):
+    """
+        Raised when the rom does not contain the expected bytes for a patch.
+        candidates lists all (bank, addr) locations in the rom where the expected bytes are found.
+    """
+    def __init__(self, message, bank_nr, addr, candidates):
+        super().__init__(message)
+        self.bank_nr = bank_nr
+        self.addr = addr
+        self.candidates = candidates
+
+
+class Bank:
+    """
+        View on a single bank inside the ROM image.
+        Reading a slice returns a copy (like slicing a bytearray would), writes go directly into the shared ROM buffer.
+    """
+    def __init__(self, rom, index):
+        self.__rom = rom
+        self.__index = index
+        self.__offset = index * BANK_SIZE
+        self.__view = memoryview(rom.data)[self.__offset:self.__offset + BANK_SIZE]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return bytearray(self.__view[item])
+        return self.__view[item]
+
+    def __setitem__(self, item, value):
+        if isinstance(item, slice):
+            if not isinstance(value, (bytes, bytearray, memoryview)):
+                value = bytes(value)
+            self.__view[item] = value
+            start, end, _ = item.indices(BANK_SIZE)
+        else:
+            self.__view[item] = value
+            start = item % BANK_SIZE
+            end = start + 1
+        self.__rom._markDirty(self.__index, start, end)
+
+    def __len__(self):
+        return BANK_SIZE
+
+    def __iter__(self):
+        return iter(self.__view)
+
+    def find(self, sub, start=0, end=BANK_SIZE):
+        result = self.__rom.data.find(sub, self.__offset + start, self.__offset + min(end, BANK_SIZE))
+        if result < 0:
+            return -1
+        return result - self.__offset
+
 
 class ROM:
     def __init__(self, filename):
-        data = open(filename, "rb").read()
-        assert len(data) == 1024 * 1024
-        self.banks = []
-        for n in range(0x40):
-            self.banks.append(bytearray(data[n*0x4000:(n+1)*0x4000]))
+        f = open(filename, "rb")
+        data = bytearray(BANK_SIZE * BANK_COUNT)
+        assert f.readinto(data) == len(data) and f.read(1) == b''
+        f.close()
+        # Keep an untouched copy of the input around, so patch files can be generated without reading it again.
+        self._load(data, bytes(data))
+
+    def _load(self, data, original):
+        self.data = data
+        self.original = original
+        self.banks = [Bank(self, n) for n in range(BANK_COUNT)]
+        # Sum of all bytes per bank, used for the global checksum. None when the bank was written since.
+        self.__checksums = [None] * BANK_COUNT
+        # List of (bank, start, end) ranges that have been written, None when not journaling.
+        self.journal = None
+        # Per bank OwnerMap of which function wrote which bytes, None when not checking for conflicts.
+        self.patch_owners = None
+        self.patch_conflicts = []
+        # When set, a mismatching patch is applied at the location of the expected bytes if there is only one.
+        self.relocate_patches = False
+        self.relocated_patches = []
+        # FreeList of the unused space in each bank, None until it is first used.
+        self.free_space = None
+
+    def __getstate__(self):
+        # The bank views cannot be pickled, they are recreated from the data on load.
+        state = dict(vars(self))
+        del state["banks"]
+        return state
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        self.banks = [Bank(self, n) for n in range(BANK_COUNT)]
+
+    def _markDirty(self, bank_nr, start, end):
+        self.__checksums[bank_nr] = None
+        if self.patch_owners is not None and start < end:
+            self.__recordPatch(bank_nr, start, end)
+        if self.journal is not None and start < end:
+            self.journal.append((bank_nr, start, end))
+        if self.free_space is not None:
+            self.free_space.claim(bank_nr, start, end)
+
+    def fork(self):
+        """
+            Create a copy of this rom that can be modified without affecting this rom.
+            The image is copied with a single buffer copy, the checksum cache and journal are carried over.
+        """
+        result = object.__new__(self.__class__)
+        result._load(bytearray(self.data), self.original)
+        result.__checksums = list(self.__checksums)
+        if self.journal is not None:
+            result.journal = list(self.journal)
+        if self.free_space is not None:
+            result.free_space = self.free_space.copy()
+        return result
+
+    def getFreeSpace(self):
+        """
+            FreeList of the unused space in each bank, as offsets inside the bank.
+            It is created on first use from the KNOWN_FREE_SPACE areas that are still empty,
+            after that every write to the rom removes the written bytes from it.
+        """
+        if self.free_space is None:
+            self.free_space = self._scanFreeSpace()
+        return self.free_space
+
+    def _scanFreeSpace(self):
+        free_space = FreeList()
+        for bank_nr, start, end in KNOWN_FREE_SPACE:
+            data = self.data[bank_nr * BANK_SIZE + start:bank_nr * BANK_SIZE + end]
+            if data[0] in FREE_SPACE_FILL and data.count(data[0]) == len(data):
+                free_space.add(bank_nr, start, end)
+        return free_space
+
+    def allocate(self, size, bank_nr=None, *, align=1):
+        """
+            Allocate size bytes of unused space, returns (bank, offset inside the bank).
+            Without a bank the first switchable bank with room is used, bank 0 is only used when asked for.
+        """
+        free_space = self.getFreeSpace()
+        if bank_nr is None:
+            banks = [n for n in free_space.banks() if n != 0]
+        else:
+            banks = [bank_nr]
+        for n in banks:
+            if free_space.largest(n) >= size:
+                addr = free_space.allocate(size, n, best_fit=True, align=align)
+                if addr is not None:
+                    return n, addr
+        raise AssertionError("Not enough free space for %d bytes%s" % (size, "" if bank_nr is None else " in bank %02x" % (bank_nr)))
+
+    def freeSpaceReport(self):
+        """
+            Free space of the whole rom and per bank, see FreeList.report.
+        """
+        free_space = self.getFreeSpace()
+        result = free_space.report()
+        result["banks"] = [dict(bank=n, **free_space.report(n)) for n in free_space.banks()]
+        return result
+
+    def startConflictCheck(self):
+        """
+            Start recording which function wrote each byte, with rom.patch or directly through rom.banks,
+            and report writes from different functions that overlap each other.
+        """
+        self.patch_owners = [OwnerMap() for n in range(BANK_COUNT)]
+        self.patch_conflicts = []
+
+    def getPatchOwner(self, bank_nr, addr):
+        assert self.patch_owners is not None, "Conflict check not started"
+        return self.patch_owners[bank_nr].owner(addr)
+
+    def __recordPatch(self, bank_nr, start, end):
+        # The owner is the first function outside of this file, so writes through rom.patch and through rom.banks are the same.
+        caller = sys._getframe(1)
+        while caller.f_code.co_filename == __file__:
+            caller = caller.f_back
+        owner = "%s.%s" % (caller.f_globals.get("__name__"), caller.f_code.co_name)
+        for conflict_start, conflict_end, other in self.patch_owners[bank_nr].claim(start, end, owner):
+            self.patch_conflicts.append((bank_nr, conflict_start, conflict_end, other, owner))
+            print("Patch conflict at %02x:%04x-%04x between %s and %s" % (bank_nr, conflict_start, conflict_end, other, owner))
+
+    def startJournal(self):
+        self.journal = []
+
+    def getDirtyRanges(self):
+        """
+            Returns a sorted list of non-overlapping (start, end) offsets in the full rom image
+            which have been written since startJournal was called.
+        """
+        assert self.journal is not None, "Journal not started"
+        result = []
+        for bank_nr, start, end in sorted(self.journal):
+            start += bank_nr * BANK_SIZE
+            end += bank_nr * BANK_SIZE
+            if result and result[-1][1] >= start:
+                result[-1] = (result[-1][0], max(result[-1][1], end))
+            else:
+                result.append((start, end))
+        return result
+
+    def findAll(self, data):
+        """
+            Find all locations of data in the whole rom, returns a list of (bank, addr) tuples.
+            This searches the single rom buffer, so it runs at native speed instead of looping bank by bank.
+        """
+        result = []
+        if not data:
+            return result
+        loc = self.data.find(data)
+        while loc > -1:
+            # A match that crosses into the next bank cannot be patched as a whole.
+            if loc // BANK_SIZE == (loc + len(data) - 1) // BANK_SIZE:
+                result.append((loc // BANK_SIZE, loc % BANK_SIZE))
+            loc = self.data.find(data, loc + 1)
+        return result
 
     def patch(self, bank_nr, addr, old, new, *, fill_nop=False):
         new = h2b(new)
@@ -29,12 +249,18 @@ class ROM:
             if bank[addr:addr+len(old)] != old:
                 if bank[addr:addr + len(old)] == new:
                     # Patch is already applied.
+                    if self.patch_owners is not None:
+                        self.__recordPatch(bank_nr, addr, addr + len(new))
                     return
-                loc = bank.find(old)
-                while loc > -1:
-                    print("Possible at:", hex(loc))
-                    loc = bank.find(old, loc+1)
-                assert False, "Patch mismatch:\n%s !=\n%s at 0x%04x" % (b2h(bank[addr:addr+len(old)]), b2h(old), addr)
+                candidates = self.findAll(old)
+                for candidate_bank, candidate_addr in candidates:
+                    print("Possible at: %02x:%04x" % (candidate_bank, candidate_addr))
+                if not self.relocate_patches or len(candidates) != 1:
+                    raise PatchMismatch("Patch mismatch:\n%s !=\n%s at 0x%04x" % (b2h(bank[addr:addr+len(old)]), b2h(old), addr), bank_nr, addr, candidates)
+                print("Relocated patch from %02x:%04x to %02x:%04x" % ((bank_nr, addr) + candidates[0]))
+                self.relocated_patches.append(((bank_nr, addr), candidates[0]))
+                bank_nr, addr = candidates[0]
+                bank = self.banks[bank_nr]
         bank[addr:addr+len(new)] = new
         assert len(bank) == 0x4000
 
@@ -53,8 +279,11 @@ class ROM:
         self.banks[0][0x14E] = 0
         self.banks[0][0x14F] = 0
         checksum = 0
-        for bank in self.banks:
-            checksum = (checksum + sum(bank)) & 0xFFFF
+        for n, bank in enumerate(self.banks):
+            if self.__checksums[n] is None:
+                self.__checksums[n] = sum(bank)
+            checksum += self.__checksums[n]
+        checksum &= 0xFFFF
         self.banks[0][0x14E] = checksum >> 8
         self.banks[0][0x14F] = checksum & 0xFF
 
@@ -62,13 +291,11 @@ class ROM:
         self.fixHeader(name=name)
         if isinstance(file, str):
             f = open(file, "wb")
-            for bank in self.banks:
-                f.write(bank)
+            f.write(self.data)
             f.close()
             print("Saved:", file)
         else:
-            for bank in self.banks:
-                file.write(bank)
+            file.write(self.data)
 
     def readHexSeed(self):
         return self.banks[0x3E][0x2F00:0x2F10].hex().upper()
@@ -0,0 +1,57 @@
+import hashlib
+import os
+import pickle
+
+import assembler
+
+
+# Bump this when the layout of the pickled rom objects changes in a way the source hash would not catch.
+CACHE_VERSION = 1
+
+
+def sourceHash():
+    # Hash all the code and assembly files of the toolbox, any change to them invalidates the cache.
+    h = hashlib.sha256()
+    root = os.path.dirname(os.path.abspath(__file__))
+    for path, dirs, files in sorted(os.walk(root)):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for filename in sorted(files):
+            if filename.endswith((".py", ".asm")):
+                full_path = os.path.join(path, filename)
+                h.update(os.path.relpath(full_path, root).encode("utf-8"))
+                h.update(open(full_path, "rb").read())
+    return h.hexdigest()
+
+
+def cacheKey(input_filename):
+    h = hashlib.sha256()
+    h.update(b"%d" % (CACHE_VERSION))
+    h.update(open(input_filename, "rb").read())
+    h.update(sourceHash().encode("ascii"))
+    # The early patches are assembled with the constants setup by main, so these are part of the key as well.
+    h.update(repr(sorted(assembler.CONST_MAP.items())).encode("ascii"))
+    return h.hexdigest()
+
+
+def load(cache_path, key):
+    filename = os.path.join(cache_path, "%s.rom" % (key))
+    if not os.path.exists(filename):
+        return None
+    try:
+        return pickle.load(open(filename, "rb"))
+    except Exception as e:
+        print("Ignoring broken cache file %s: %s" % (filename, e))
+        return None
+
+
+def store(cache_path, key, rom):
+    os.makedirs(cache_path, exist_ok=True)
+    filename = os.path.join(cache_path, "%s.rom" % (key))
+    # Remove older cache entries, only the latest base rom is useful.
+    for old in os.listdir(cache_path):
+        if old.endswith(".rom"):
+            os.unlink(os.path.join(cache_path, old))
+    f = open(filename + ".tmp", "wb")
+    pickle.dump(rom, f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.replace(filename + ".tmp", filename)
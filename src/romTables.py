@@ -1,4 +1,4 @@
-from rom import ROM
+from rom import ROM, Bank, BANK_COUNT
 from pointerTable import PointerTable
 from assembler import ASM
 
@@ -13,6 +13,8 @@ class Texts(PointerTable):
             "pointers_bank": 0x1C,
             "banks_addr": 0x741,
             "banks_bank": 0x1C,
+            # Dialogs that no longer fit in their own bank are moved to the free space of the other dialog banks.
+            "overflow_banks": [0x1C, 0x1D, 0x1E, 0x1F],
         })
 
 
@@ -179,39 +181,118 @@ class IndoorRoomSpriteData(PointerTable):
         })
 
 
+class _LoadedImage:
+    """
+        Read only bank views on the rom image as it was loaded, before any patches were applied.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.banks = [Bank(self, n) for n in range(BANK_COUNT)]
+
+
+class _LazyTable:
+    """
+        Table attribute of ROMWithTables that is only parsed when it is first used.
+        The table is parsed from the rom image as it was loaded, so writes to the rom before the first use
+        do not end up in the table. This is the same as when all tables were parsed on construction.
+        After that the parsed table is stored on the rom object itself, which hides this descriptor.
+    """
+    def __init__(self, table_class):
+        self.__table_class = table_class
+        self.__name = None
+
+    def __set_name__(self, owner, name):
+        self.__name = name
+
+    def __get__(self, rom, owner=None):
+        if rom is None:
+            return self
+        table = self.__table_class(_LoadedImage(rom.original))
+        vars(rom)[self.__name] = table
+        if rom.free_space is not None:
+            rom._claimTableStorage(rom.free_space, table)
+        return table
+
+
 class ROMWithTables(ROM):
-    def __init__(self, filename):
-        super().__init__(filename)
-
-        # Ability to patch any text in the game with different text
-        self.texts = Texts(self)
-        # Ability to modify rooms
-        self.entities = Entities(self)
-        self.rooms_overworld_top = RoomsOverworldTop(self)
-        self.rooms_overworld_bottom = RoomsOverworldBottom(self)
-        self.rooms_indoor_a = RoomsIndoorA(self)
-        self.rooms_indoor_b = RoomsIndoorB(self)
-        self.rooms_color_dungeon = RoomsColorDungeon(self)
-        self.room_sprite_data_overworld = OverworldRoomSpriteData(self)
-        self.room_sprite_data_indoor = IndoorRoomSpriteData(self)
-
-        # Backgrounds for things like the title screen.
-        self.background_tiles = BackgroundTilesTable(self)
-        self.background_attributes = BackgroundAttributeTable(self)
-
-    def save(self, filename, *, name=None):
-        self.texts.store(self)
-        self.entities.store(self)
-        self.rooms_overworld_top.store(self)
-        self.rooms_overworld_bottom.store(self)
-        self.rooms_indoor_a.store(self)
-        self.rooms_indoor_b.store(self)
-        self.rooms_color_dungeon.store(self)
-        leftover_storage = self.room_sprite_data_overworld.store(self)
-        self.room_sprite_data_indoor.addStorage(leftover_storage)
-        self.patch(0x00, 0x0DFA, ASM("ld hl, $763B"), ASM("ld hl, $%04x" % (leftover_storage[0]["start"] | 0x4000)))
-        self.room_sprite_data_indoor.adjustDataStart(leftover_storage[0]["start"])
-        self.room_sprite_data_indoor.store(self)
-        self.background_tiles.store(self)
-        self.background_attributes.store(self)
+    # Ability to patch any text in the game with different text
+    texts = _LazyTable(Texts)
+    # Ability to modify rooms
+    entities = _LazyTable(Entities)
+    rooms_overworld_top = _LazyTable(RoomsOverworldTop)
+    rooms_overworld_bottom = _LazyTable(RoomsOverworldBottom)
+    rooms_indoor_a = _LazyTable(RoomsIndoorA)
+    rooms_indoor_b = _LazyTable(RoomsIndoorB)
+    rooms_color_dungeon = _LazyTable(RoomsColorDungeon)
+    room_sprite_data_overworld = _LazyTable(OverworldRoomSpriteData)
+    room_sprite_data_indoor = _LazyTable(IndoorRoomSpriteData)
+
+    # Backgrounds for things like the title screen.
+    background_tiles = _LazyTable(BackgroundTilesTable)
+    background_attributes = _LazyTable(BackgroundAttributeTable)
+
+    def isTableLoaded(self, name):
+        return name in vars(self)
+
+    @classmethod
+    def tableNames(cls):
+        return [name for name, value in vars(cls).items() if isinstance(value, _LazyTable)]
+
+    def _scanFreeSpace(self):
+        # The storage areas of the tables are not free for other uses, even when parts are unused right now.
+        # Tables that are not loaded yet claim theirs when they are loaded, so they do not need to be parsed for this.
+        free_space = super()._scanFreeSpace()
+        for table_name in self.tableNames():
+            if self.isTableLoaded(table_name):
+                self._claimTableStorage(free_space, getattr(self, table_name))
+        return free_space
+
+    @staticmethod
+    def _claimTableStorage(free_space, table):
+        for block in table.getStorage():
+            free_space.claim(block["bank"], block["start"], block["end"])
+
+    def spaceReport(self):
+        """
+            Storage space report of every table, see PointerTable.spaceReport. Tables that are not loaded yet are loaded for this.
+        """
+        return {table_name: getattr(self, table_name).spaceReport() for table_name in self.tableNames()}
+
+    def fork(self):
+        result = super().fork()
+        for key, value in vars(self).items():
+            if isinstance(value, PointerTable):
+                setattr(result, key, value.fork())
+        return result
+
+    def save(self, filename, *, name=None, packing="first_fit"):
+        # Tables that were never used cannot have been modified, so only the loaded tables are stored.
+        for table_name in ("texts", "entities", "rooms_overworld_top", "rooms_overworld_bottom",
+                           "rooms_indoor_a", "rooms_indoor_b", "rooms_color_dungeon"):
+            if self.isTableLoaded(table_name):
+                table = getattr(self, table_name)
+                table.store(self, packing=packing)
+                if table.packing_report is not None:
+                    self.__printPackingReport(table_name, table.packing_report)
+        if self.isTableLoaded("room_sprite_data_overworld") or self.isTableLoaded("room_sprite_data_indoor"):
+            # The indoor sprite data is placed in the space left over by the overworld sprite data, so these go together.
+            # Both are loaded before storing anything, so neither is parsed from half written data.
+            overworld, indoor = self.room_sprite_data_overworld, self.room_sprite_data_indoor
+            leftover_storage = overworld.store(self)
+            if leftover_storage:
+                indoor.addStorage(leftover_storage)
+                self.patch(0x00, 0x0DFA, ASM("ld hl, $763B"), ASM("ld hl, $%04x" % (leftover_storage[0]["start"] | 0x4000)))
+                indoor.adjustDataStart(leftover_storage[0]["start"])
+            indoor.store(self)
+        for table_name in ("background_tiles", "background_attributes"):
+            if self.isTableLoaded(table_name):
+                getattr(self, table_name).store(self)
         super().save(filename, name=name)
+
+    @staticmethod
+    def __printPackingReport(table_name, report):
+        if report["first_fit_used"] is None:
+            print("%s: %s packing uses %d bytes, does not fit with first fit" % (table_name, report["packing"], report["used"]))
+        else:
+            print("%s: %s packing uses %d bytes, recovered %d bytes compared to first fit, largest free block %d (was %d)" % (
+                table_name, report["packing"], report["used"], report["recovered"], report["largest_free"], report["first_fit_largest_free"]))
@@ -6,6 +6,37 @@ WARP_TYPE_IDS = {0xE1, 0xE2, 0xE3, 0xBA, 0xA8, 0xBE, 0xCB, 0xC2, 0xC6}
 ALT_ROOM_OVERLAYS = {"Alt06": 0x1040, "Alt0E": 0x1090, "Alt1B": 0x10E0, "Alt2B": 0x1130, "Alt79": 0x1180, "Alt8C": 0x11D0}
 
 
+def storeObjects(rom, room, objects_raw):
+    if isinstance(room, str):
+        if room in rom.rooms_overworld_top:
+            rom.rooms_overworld_top[room] = objects_raw
+        elif room in rom.rooms_overworld_bottom:
+            rom.rooms_overworld_bottom[room] = objects_raw
+        elif room in rom.rooms_indoor_a:
+            rom.rooms_indoor_a[room] = objects_raw
+        else:
+            assert False, "Failed to find alt room: %s" % (room)
+    elif room < 0x080:
+        rom.rooms_overworld_top[room] = objects_raw
+    elif room < 0x100:
+        rom.rooms_overworld_bottom[room - 0x80] = objects_raw
+    elif room < 0x200:
+        rom.rooms_indoor_a[room - 0x100] = objects_raw
+    elif room < 0x300:
+        rom.rooms_indoor_b[room - 0x200] = objects_raw
+    else:
+        rom.rooms_color_dungeon[room - 0x300] = objects_raw
+
+
+def storeOverlay(rom, room, overlay):
+    if isinstance(room, int) and room < 0x0CC:
+        rom.banks[0x26][room * 80:room * 80 + 80] = overlay
+    elif isinstance(room, int) and room < 0x100:
+        rom.banks[0x27][(room - 0xCC) * 80:(room - 0xCC) * 80 + 80] = overlay
+    elif room in ALT_ROOM_OVERLAYS:
+        rom.banks[0x27][ALT_ROOM_OVERLAYS[room]:ALT_ROOM_OVERLAYS[room] + 80] = overlay
+
+
 class RoomEditor:
     def __init__(self, rom, room=None):
         assert room is not None
@@ -87,30 +118,7 @@ class RoomEditor:
     def store(self, rom, new_room_nr=None):
         if new_room_nr is None:
             new_room_nr = self.room
-        objects_raw = bytearray([self.animation_id, self.floor_object])
-        for obj in self.objects:
-            objects_raw += obj.export()
-        objects_raw += bytearray([0xFE])
-
-        if isinstance(new_room_nr, str):
-            if new_room_nr in rom.rooms_overworld_top:
-                rom.rooms_overworld_top[new_room_nr] = objects_raw
-            elif new_room_nr in rom.rooms_overworld_bottom:
-                rom.rooms_overworld_bottom[new_room_nr] = objects_raw
-            elif new_room_nr in rom.rooms_indoor_a:
-                rom.rooms_indoor_a[new_room_nr] = objects_raw
-            else:
-                assert False, "Failed to find alt room: %s" % (new_room_nr)
-        elif new_room_nr < 0x080:
-            rom.rooms_overworld_top[new_room_nr] = objects_raw
-        elif new_room_nr < 0x100:
-            rom.rooms_overworld_bottom[new_room_nr - 0x80] = objects_raw
-        elif new_room_nr < 0x200:
-            rom.rooms_indoor_a[new_room_nr - 0x100] = objects_raw
-        elif new_room_nr < 0x300:
-            rom.rooms_indoor_b[new_room_nr - 0x200] = objects_raw
-        else:
-            rom.rooms_color_dungeon[new_room_nr - 0x300] = objects_raw
+        storeObjects(rom, new_room_nr, self.getObjectsRaw())
 
         if isinstance(new_room_nr, int) and new_room_nr < 0x100:
             if self.tileset_index is not None:
@@ -124,18 +132,22 @@ class RoomEditor:
                 rom.banks[0x21][0x02ef + new_room_nr] = self.palette_index
 
         if isinstance(new_room_nr, int):
-            entities_raw = bytearray()
-            for entity in self.entities:
-                entities_raw += bytearray([entity[0] | entity[1] << 4, entity[2]])
-            entities_raw += bytearray([0xFF])
-            rom.entities[new_room_nr] = entities_raw
-
-            if new_room_nr < 0x0CC:
-                rom.banks[0x26][new_room_nr * 80:new_room_nr * 80 + 80] = self.overlay
-            elif new_room_nr < 0x100:
-                rom.banks[0x27][(new_room_nr - 0xCC) * 80:(new_room_nr - 0xCC) * 80 + 80] = self.overlay
-        elif new_room_nr in ALT_ROOM_OVERLAYS:
-            rom.banks[0x27][ALT_ROOM_OVERLAYS[new_room_nr]:ALT_ROOM_OVERLAYS[new_room_nr] + 80] = self.overlay
+            rom.entities[new_room_nr] = self.getEntitiesRaw()
+        storeOverlay(rom, new_room_nr, self.overlay)
+
+    def getObjectsRaw(self):
+        objects_raw = bytearray([self.animation_id, self.floor_object])
+        for obj in self.objects:
+            objects_raw += obj.export()
+        objects_raw += bytearray([0xFE])
+        return objects_raw
+
+    def getEntitiesRaw(self):
+        entities_raw = bytearray()
+        for entity in self.entities:
+            entities_raw += bytearray([entity[0] | entity[1] << 4, entity[2]])
+        entities_raw += bytearray([0xFF])
+        return entities_raw
 
     def addEntity(self, x, y, type_id):
         self.entities.append((x, y, type_id))
@@ -0,0 +1,137 @@
+BANK_SIZE = 0x4000
+
+
+class SuffixAutomaton:
+    """
+        Generalized suffix automaton over a set of byte strings, built online.
+        Every substring of the added strings can be found in time linear to its length,
+        and each state remembers the address of the last byte of one of its occurrences.
+    """
+    def __init__(self):
+        self.__next = [{}]
+        self.__link = [-1]
+        self.__length = [0]
+        self.__end = [-1]
+
+    def extend(self, state, data, addr):
+        """
+            Append data, which is located at addr, to the string which ends in state. Use state 0 to start a new string.
+            Returns the state to continue this string from.
+        """
+        for offset, c in enumerate(data):
+            state = self.__extend(state, c, addr + offset)
+        return state
+
+    def find(self, data):
+        """
+            Returns the address of an occurrence of data, or None if it is not a substring of any of the added strings.
+        """
+        if not data:
+            return None
+        state = 0
+        for c in data:
+            state = self.__next[state].get(c)
+            if state is None:
+                return None
+        return self.__end[state] - len(data) + 1
+
+    def __extend(self, last, c, addr):
+        nxt = self.__next
+        length = self.__length
+        if c in nxt[last]:
+            # The extended string already exists, which happens when data repeats between strings.
+            q = nxt[last][c]
+            if length[q] == length[last] + 1:
+                return q
+            clone = self.__clone(q, length[last] + 1)
+            p = last
+            while p != -1 and nxt[p].get(c) == q:
+                nxt[p][c] = clone
+                p = self.__link[p]
+            return clone
+
+        cur = self.__newState({}, -1, length[last] + 1, addr)
+        p = last
+        while p != -1 and c not in nxt[p]:
+            nxt[p][c] = cur
+            p = self.__link[p]
+        if p == -1:
+            self.__link[cur] = 0
+        else:
+            q = nxt[p][c]
+            if length[p] + 1 == length[q]:
+                self.__link[cur] = q
+            else:
+                clone = self.__clone(q, length[p] + 1)
+                while p != -1 and nxt[p].get(c) == q:
+                    nxt[p][c] = clone
+                    p = self.__link[p]
+                self.__link[cur] = clone
+        return cur
+
+    def __clone(self, q, length):
+        clone = self.__newState(dict(self.__next[q]), self.__link[q], length, self.__end[q])
+        self.__link[q] = clone
+        return clone
+
+    def __newState(self, nxt, link, length, end):
+        self.__next.append(nxt)
+        self.__link.append(link)
+        self.__length.append(length)
+        self.__end.append(end)
+        return len(self.__next) - 1
+
+
+def overlap(tail, head):
+    """
+        Returns the length of the longest proper prefix of head that is also a suffix of tail.
+    """
+    if not head or not tail:
+        return 0
+    tail = tail[-(len(head) - 1):] if len(head) > 1 else b""
+    # Knuth-Morris-Pratt prefix function over head, followed by a separator that never matches and the tail.
+    text = list(head) + [-1] + list(tail)
+    prefix = [0] * len(text)
+    for n in range(1, len(text)):
+        k = prefix[n - 1]
+        while k > 0 and text[n] != text[k]:
+            k = prefix[k - 1]
+        if text[n] == text[k]:
+            k += 1
+        prefix[n] = k
+    return prefix[-1]
+
+
+class PlacedData:
+    """
+        Index of all the data that has been placed in a single bank.
+        Data that is placed directly after earlier data continues the same run, so matches can span multiple entries.
+    """
+    def __init__(self):
+        self.__automaton = SuffixAutomaton()
+        self.__image = bytearray(BANK_SIZE)
+        # Runs of placed data, keyed on the end address, as (start address, automaton state).
+        self.__runs = {}
+
+    def add(self, addr, data):
+        if addr in self.__runs:
+            start, state = self.__runs.pop(addr)
+        else:
+            start, state = addr, 0
+        self.__image[addr:addr + len(data)] = data
+        self.__runs[addr + len(data)] = (start, self.__automaton.extend(state, data, addr))
+
+    def find(self, data):
+        return self.__automaton.find(data)
+
+    def findOverlap(self, data, is_free):
+        """
+            Find the run whose tail overlaps the most with the head of data, while the rest of data fits in free space after it.
+            is_free(start, end) tells if the area is free. Returns (address, overlap size) or (None, 0).
+        """
+        best_addr, best_size = None, 0
+        for end, (start, _) in self.__runs.items():
+            size = overlap(self.__image[max(start, end - len(data) + 1):end], data)
+            if size > best_size and is_free(end, end + len(data) - size):
+                best_addr, best_size = end - size, size
+        return best_addr, best_size
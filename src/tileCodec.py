@@ -0,0 +1,110 @@
+import numpy
+import PIL.Image
+
+# Pixels of each byte of a bit plane, most significant bit first.
+_BITS = numpy.unpackbits(numpy.arange(256, dtype=numpy.uint8)[:, None], axis=1)
+
+ATTR_PALETTE = 0x07
+ATTR_FLIP_X = 0x20
+ATTR_FLIP_Y = 0x40
+
+# Rendered 16x16 metatiles, keyed on the data of their 4 tiles and the 4 attributes.
+METATILE_CACHE_SIZE = 0x10000
+_metatile_cache = {}
+
+
+def decode(data):
+    """
+        Decode 2bpp tile data into an array of 8x8 tiles of color indexes, shaped (tiles, 8, 8).
+        8x16 tiles are two 8x8 tiles after each other, so those can be reshaped to (tiles, 16, 8).
+    """
+    planes = numpy.frombuffer(bytes(data), dtype=numpy.uint8).reshape(-1, 8, 2)
+    return _BITS[planes[:, :, 0]] | (_BITS[planes[:, :, 1]] << 1)
+
+
+def encode(tiles):
+    """
+        Encode tiles of color indexes, shaped (tiles, height, 8), into 2bpp tile data. Colors are masked to 2 bits.
+    """
+    tiles = numpy.asarray(tiles, dtype=numpy.uint8)
+    result = numpy.empty(tiles.shape[:-1] + (2, ), dtype=numpy.uint8)
+    result[..., 0] = numpy.packbits(tiles & 1, axis=-1)[..., 0]
+    result[..., 1] = numpy.packbits((tiles >> 1) & 1, axis=-1)[..., 0]
+    return result.tobytes()
+
+
+def applyAttributes(tiles, attrs):
+    """
+        Apply background attributes to decoded tiles: the flip bits and the palette, which selects colors palette * 4 + color.
+    """
+    attrs = numpy.asarray(attrs, dtype=numpy.uint8)
+    tiles = numpy.where((attrs & ATTR_FLIP_X)[:, None, None] != 0, tiles[:, :, ::-1], tiles)
+    tiles = numpy.where((attrs & ATTR_FLIP_Y)[:, None, None] != 0, tiles[:, ::-1, :], tiles)
+    return tiles | ((attrs & ATTR_PALETTE) << 2)[:, None, None]
+
+
+def arrange(tiles, columns):
+    """
+        Place tiles shaped (tiles, height, width) left to right and top to bottom in a single image of pixels.
+    """
+    count, height, width = tiles.shape
+    rows = count // columns
+    return tiles.reshape(rows, columns, height, width).transpose(0, 2, 1, 3).reshape(rows * height, columns * width)
+
+
+def split(pixels, tile_height=8):
+    """
+        The reverse of arrange, cut an image of pixels into tiles shaped (tiles, tile_height, 8).
+    """
+    pixels = numpy.asarray(pixels)
+    height, width = pixels.shape
+    rows = height // tile_height
+    columns = width // 8
+    return pixels[:rows * tile_height, :columns * 8].reshape(rows, tile_height, columns, 8).transpose(0, 2, 1, 3).reshape(-1, tile_height, 8)
+
+
+def renderMetatiles(tile_data, metatile_info, attr_info=None):
+    """
+        Render all 256 metatiles of 16x16 pixels as a 16 by 16 grid of metatiles.
+        metatile_info has the 4 tile indexes of each metatile, top left, top right, bottom left and bottom right,
+        attr_info has the matching attributes, without it all tiles use palette 0.
+        Rendered metatiles are cached on their tile data and attributes, so tilesets that share tiles reuse them.
+        The palette colors are not part of the pixels, so tilesets that only differ in palette share everything.
+    """
+    tile_data = numpy.frombuffer(bytes(tile_data), dtype=numpy.uint8).reshape(-1, 16)
+    indexes = numpy.frombuffer(bytes(metatile_info), dtype=numpy.uint8).reshape(256, 4)
+    if attr_info is None:
+        attrs = numpy.zeros((256, 4), dtype=numpy.uint8)
+    else:
+        attrs = numpy.frombuffer(bytes(attr_info), dtype=numpy.uint8).reshape(256, 4)
+    keys = [key.tobytes() for key in numpy.concatenate((tile_data[indexes].reshape(256, 64), attrs), axis=1)]
+
+    missing = [n for n, key in enumerate(keys) if key not in _metatile_cache]
+    if missing:
+        if len(_metatile_cache) + len(missing) > METATILE_CACHE_SIZE:
+            _metatile_cache.clear()
+        tiles = decode(tile_data[indexes[missing]].tobytes())
+        tiles = applyAttributes(tiles, attrs[missing].reshape(-1))
+        # Each metatile is 2x2 tiles.
+        for n, metatile in zip(missing, tiles.reshape(-1, 2, 2, 8, 8).transpose(0, 1, 3, 2, 4).reshape(-1, 16, 16)):
+            _metatile_cache[keys[n]] = metatile
+    metatiles = numpy.stack([_metatile_cache[key] for key in keys])
+    return arrange(metatiles, 16)
+
+
+def toImage(pixels, palette=None):
+    """
+        Create a paletted image from an array of color indexes.
+    """
+    pixels = numpy.ascontiguousarray(pixels, dtype=numpy.uint8)
+    img = PIL.Image.frombytes("P", (pixels.shape[1], pixels.shape[0]), pixels.tobytes())
+    if palette is not None:
+        img.putpalette(palette)
+    return img
+
+
+def fromImage(img):
+    """
+        Returns the color indexes of a paletted image as an array of pixels.
+    """
+    return numpy.asarray(img, dtype=numpy.uint8)
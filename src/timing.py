@@ -0,0 +1,359 @@
+import bisect
+
+# Machine cycles (1 M-cycle = 4 clocks) in a single frame in normal speed mode.
+FRAME_CYCLES = 17556
+
+# Per opcode (size, cycles, cycles when the branch is taken), None for opcodes that do not exist.
+OPCODES = [None] * 256
+# CB prefixed opcodes are all 2 bytes, the cycles depend on the operand.
+CB_CYCLES = [4 if n & 0x07 == 6 else 2 for n in range(256)]
+
+
+def _buildOpcodeTable():
+    for n in range(0x40, 0x80, 0x08):
+        CB_CYCLES[n | 6] = 3  # bit n, [hl]
+    for n in range(0x00, 0x40):
+        low = n & 0x0F
+        if low in (0x01, ):
+            OPCODES[n] = (3, 3, None)
+        elif low in (0x02, 0x03, 0x09, 0x0A, 0x0B):
+            OPCODES[n] = (1, 2, None)
+        elif low in (0x04, 0x05, 0x0C, 0x0D):
+            OPCODES[n] = (1, 3 if n in (0x34, 0x35) else 1, None)
+        elif low in (0x06, 0x0E):
+            OPCODES[n] = (2, 3 if n == 0x36 else 2, None)
+        elif low in (0x07, 0x0F):
+            OPCODES[n] = (1, 1, None)
+    OPCODES[0x00] = (1, 1, None)
+    OPCODES[0x08] = (3, 5, None)
+    OPCODES[0x10] = (2, 1, None)
+    OPCODES[0x18] = (2, 3, 3)
+    for n in (0x20, 0x28, 0x30, 0x38):
+        OPCODES[n] = (2, 2, 3)
+    for n in range(0x40, 0xC0):
+        # ld r, r and the alu operations, one more cycle when [hl] is used.
+        uses_hl = n & 0x07 == 6 or 0x70 <= n < 0x78
+        OPCODES[n] = (1, 2 if uses_hl else 1, None)
+    OPCODES[0x76] = (1, 1, None)  # halt
+    for n in range(0xC0, 0x100, 0x08):
+        OPCODES[n | 0x07] = (1, 4, 4)  # rst
+        OPCODES[n | 0x06] = (2, 2, None)  # alu a, d8
+    for n in (0xC0, 0xC8, 0xD0, 0xD8):
+        OPCODES[n] = (1, 2, 5)  # ret cc
+        OPCODES[n + 2] = (3, 3, 4)  # jp cc
+        OPCODES[n + 4] = (3, 3, 6)  # call cc
+    for n in (0xC1, 0xD1, 0xE1, 0xF1):
+        OPCODES[n] = (1, 3, None)  # pop
+        OPCODES[n + 4] = (1, 4, None)  # push
+    OPCODES[0xC3] = (3, 4, 4)
+    OPCODES[0xC9] = (1, 4, 4)
+    OPCODES[0xCB] = (2, None, None)
+    OPCODES[0xCD] = (3, 6, 6)
+    OPCODES[0xD9] = (1, 4, 4)
+    OPCODES[0xE0] = (2, 3, None)
+    OPCODES[0xE2] = (1, 2, None)
+    OPCODES[0xE8] = (2, 4, None)
+    OPCODES[0xE9] = (1, 1, 1)
+    OPCODES[0xEA] = (3, 4, None)
+    OPCODES[0xF0] = (2, 3, None)
+    OPCODES[0xF2] = (1, 2, None)
+    OPCODES[0xF3] = (1, 1, None)
+    OPCODES[0xF8] = (2, 3, None)
+    OPCODES[0xF9] = (1, 2, None)
+    OPCODES[0xFA] = (3, 4, None)
+    OPCODES[0xFB] = (1, 1, None)
+
+
+_buildOpcodeTable()
+
+
+def instructionCycles(data, offset=0):
+    """
+        Decode the instruction at offset, returns (size, cycles, cycles when the branch is taken).
+        The last one is None for instructions that do not branch.
+    """
+    opcode = data[offset]
+    assert OPCODES[opcode] is not None, "Invalid opcode: %02x" % (opcode)
+    if opcode == 0xCB:
+        return 2, CB_CYCLES[data[offset + 1]], None
+    return OPCODES[opcode]
+
+
+def formatCycles(data, offset=0):
+    size, cycles, taken = instructionCycles(data, offset)
+    if taken is None or taken == cycles:
+        return "%d" % (cycles)
+    return "%d/%d" % (cycles, taken)
+
+
+class TimingAnalyzer:
+    """
+        Static timing analysis of code, without running it.
+        data is the memory that is visible to the code starting at base_address, for example bank 0 followed by a switchable bank.
+        For each routine the best and worst case number of M-cycles over all paths from the entry to a return is calculated.
+
+        Calls into the analyzed memory are analyzed as routines as well. Calls and jumps to other addresses cost
+        what is given for them in call_costs as (best, worst), including their return, or are reported as unknown.
+        Calls to addresses in no_return end the path as an unknown call, like the rst 0 jump table that does not return to its caller.
+        Loops need a bound on their number of iterations to get a worst case. loop_bounds gives this per loop start address,
+        loops without a bound use default_loop_bound. The bound counts the iterations each time the loop is entered,
+        so an inner loop can repeat up to its bound on every iteration of the outer loop.
+    """
+    EXIT = -1
+
+    def __init__(self, data, base_address=0, *, call_costs=None, loop_bounds=None, default_loop_bound=None, no_return=()):
+        self.__data = data
+        self.__base_address = base_address
+        self.__call_costs = call_costs or {}
+        self.__loop_bounds = loop_bounds or {}
+        self.__default_loop_bound = default_loop_bound
+        self.__no_return = set(no_return)
+        self.__routines = {}
+        self.__busy = set()
+        self.__unknown_calls = set()
+        self.__unbounded_loops = set()
+
+    def analyze(self, entry):
+        """
+            Returns a dict with the best and worst case M-cycles of the routine at entry.
+            worst is None when it is unbounded because of a loop without a bound or recursion.
+            Unknown calls are counted as free, so with unknown calls the result is a lower bound.
+        """
+        self.__routines = {}
+        self.__unknown_calls = set()
+        self.__unbounded_loops = set()
+        best, worst = self.__routine(entry)
+        return {
+            "entry": entry,
+            "best": best,
+            "worst": worst,
+            "unknown_calls": sorted(self.__unknown_calls),
+            "unbounded_loops": sorted(self.__unbounded_loops),
+            "calls": {addr: cost for addr, cost in sorted(self.__routines.items()) if addr != entry},
+        }
+
+    def __isInside(self, addr):
+        return self.__base_address <= addr < self.__base_address + len(self.__data)
+
+    def __routine(self, entry):
+        if entry in self.__routines:
+            return self.__routines[entry]
+        if entry in self.__busy:
+            # Recursion, there is no bound on the depth.
+            self.__unbounded_loops.add(entry)
+            return 0, None
+        self.__busy.add(entry)
+        result = self.__pathCost(entry)
+        self.__busy.remove(entry)
+        self.__routines[entry] = result
+        return result
+
+    def __callCost(self, target):
+        # Cost of a call including the return, as (best, worst).
+        if target in self.__call_costs:
+            return self.__call_costs[target]
+        if self.__isInside(target):
+            return self.__routine(target)
+        self.__unknown_calls.add(target)
+        return 0, 0
+
+    def __edges(self, addr):
+        """
+            Returns the ways to continue after the instruction at addr as a list of (next address or EXIT, best, worst)
+            where best and worst are the cycles spend to get there.
+        """
+        if not self.__isInside(addr):
+            # Running off the end of the analyzed memory.
+            return [(self.EXIT, 0, 0)]
+        offset = addr - self.__base_address
+        opcode = self.__data[offset]
+        assert OPCODES[opcode] is not None, "Invalid opcode %02x at %04x, data is reached as code" % (opcode, addr)
+        size, cycles, taken = instructionCycles(self.__data, offset)
+        following = addr + size
+        if taken is None:
+            return [(following, cycles, cycles)]
+        if opcode in (0xC9, 0xD9):
+            return [(self.EXIT, cycles, cycles)]
+        if opcode in (0xC0, 0xC8, 0xD0, 0xD8):
+            return [(following, cycles, cycles), (self.EXIT, taken, taken)]
+        if opcode == 0xE9:
+            self.__unknown_calls.add(addr)  # jp hl, the target is not known.
+            return [(self.EXIT, cycles, cycles)]
+        if opcode & 0xC7 == 0xC7:
+            target = opcode & 0x38
+        elif opcode & 0xE7 == 0x20 or opcode == 0x18:
+            target = following + ((self.__data[offset + 1] ^ 0x80) - 0x80)
+        else:
+            target = self.__data[offset + 1] | (self.__data[offset + 2] << 8)
+        result = []
+        if taken != cycles or opcode & 0xE7 == 0x20:
+            result.append((following, cycles, cycles))
+        if opcode in (0xCD, 0xC4, 0xCC, 0xD4, 0xDC) or opcode & 0xC7 == 0xC7:
+            if target in self.__no_return:
+                # This continues somewhere else, which is not known.
+                self.__unknown_calls.add(target)
+                result.append((self.EXIT, taken, taken))
+            else:
+                best, worst = self.__callCost(target)
+                result.append((following, taken + best, None if worst is None else taken + worst))
+        elif self.__isInside(target):
+            result.append((target, taken, taken))
+        else:
+            # Jump out of the analyzed memory, this continues in a routine that does the return for us.
+            best, worst = self.__callCost(target)
+            result.append((self.EXIT, taken + best, None if worst is None else taken + worst))
+        return result
+
+    def __findLoops(self, entry, edges):
+        """
+            Depth first search over the control flow, every edge to an address that is on the current path closes a loop.
+            Returns the sorted loop start addresses, the set of (from, to) edges that close a loop
+            and for each reached address the indexes of the loops it is part of.
+        """
+        back_edges = set()
+        predecessors = {entry: set()}
+        on_path = {entry}
+        stack = [(entry, iter(edges(entry)))]
+        while stack:
+            addr, addr_edges = stack[-1]
+            for target, _, _ in addr_edges:
+                if target == self.EXIT:
+                    continue
+                if target in on_path:
+                    back_edges.add((addr, target))
+                if target not in predecessors:
+                    predecessors[target] = {addr}
+                    on_path.add(target)
+                    stack.append((target, iter(edges(target))))
+                    break
+                predecessors[target].add(addr)
+            else:
+                stack.pop()
+                on_path.remove(addr)
+        headers = sorted(set(target for _, target in back_edges))
+
+        # The body of a loop is everything that leads back to its start without passing the start.
+        loops = {addr: [] for addr in predecessors}
+        for idx, header in enumerate(headers):
+            body = {header}
+            todo = [source for source, target in back_edges if target == header]
+            while todo:
+                addr = todo.pop()
+                if addr not in body:
+                    body.add(addr)
+                    todo += predecessors[addr]
+            for addr in body:
+                loops[addr].append(idx)
+        return headers, back_edges, loops
+
+    def __pathCost(self, entry):
+        """
+            Best and worst path cost from entry to an exit. Each node is an address together with how often each loop
+            that contains it has been repeated, so the graph has no cycles and the costs follow from those of the next nodes.
+            Leaving a loop resets its count, so loops after each other add up instead of multiplying the number of nodes.
+        """
+        edge_cache = {}
+
+        def edges(addr):
+            if addr not in edge_cache:
+                edge_cache[addr] = self.__edges(addr)
+            return edge_cache[addr]
+
+        headers, back_edges, loops = self.__findLoops(entry, edges)
+        bounds = []
+        for header in headers:
+            bound = self.__loop_bounds.get(header, self.__default_loop_bound)
+            if bound is None:
+                self.__unbounded_loops.add(header)
+            bounds.append(bound)
+
+        # Per node (best, worst), best is None when there is no way to exit and worst is None when it is unbounded.
+        memo = {}
+        start = (entry, (0, ) * len(headers))
+        stack = [(start, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if node in memo:
+                continue
+            successors = self.__successors(node, edges, bounds, back_edges, loops, headers)
+            if not expanded:
+                stack.append((node, True))
+                for next_node, _, _ in successors:
+                    if next_node != self.EXIT and next_node not in memo:
+                        stack.append((next_node, False))
+                continue
+            best = worst = None
+            unbounded = False
+            for next_node, edge_best, edge_worst in successors:
+                next_best, next_worst = (0, 0) if next_node == self.EXIT else memo[next_node]
+                if next_best is None:
+                    continue
+                if best is None or edge_best + next_best < best:
+                    best = edge_best + next_best
+                if edge_worst is None or next_worst is None:
+                    unbounded = True
+                elif worst is None or edge_worst + next_worst > worst:
+                    worst = edge_worst + next_worst
+            memo[node] = (best, None if unbounded else worst)
+        return memo[start]
+
+    def __successors(self, node, edges, bounds, back_edges, loops, headers):
+        # The next nodes as (node, best, worst), worst is None when repeating a loop that has no bound.
+        addr, counts = node
+        result = []
+        for target, best, worst in edges(addr):
+            if target == self.EXIT:
+                result.append((self.EXIT, best, worst))
+                continue
+            target_loops = loops[target]
+            next_counts = tuple(counts[idx] if idx in target_loops else 0 for idx in range(len(counts)))
+            if (addr, target) in back_edges:
+                idx = bisect.bisect_left(headers, target)
+                if bounds[idx] is None:
+                    # Without a bound the loop is repeated once, only to find the best case.
+                    if counts[idx] > 0:
+                        continue
+                    worst = None
+                elif counts[idx] + 1 >= bounds[idx]:
+                    continue
+                next_counts = next_counts[:idx] + (counts[idx] + 1, ) + next_counts[idx + 1:]
+            result.append(((target, next_counts), best, worst))
+        return result
+
+
+def analyze(data, base_address, entry=None, **kwargs):
+    """
+        Timing analysis of the routine at entry in data, see TimingAnalyzer for the options.
+    """
+    if entry is None:
+        entry = base_address
+    return TimingAnalyzer(data, base_address, **kwargs).analyze(entry)
+
+
+def frameReport(rom, *, call_costs=None, loop_bounds=None, default_loop_bound=None):
+    """
+        Timing of the code that runs every frame, with bank 0 and bank 3E mapped in.
+        The rst 0 jump table does not return to its caller. Returns a list of dicts with the name of each installed hook,
+        the analysis result and if the worst case is known to fit in a frame.
+    """
+    memory = bytes(rom.banks[0]) + bytes(rom.banks[0x3E])
+    hooks = []
+    # The ingame time counter is called from the main loop in bank 0.
+    if rom.banks[0][0x0367:0x036A] == b"\xCD\x91\x00":
+        hooks.append(("FrameCounter", 0x0091))
+    # Bank 3E starts with a call to its jump table, entry 0 is called every frame and handles the serial link.
+    bank3e = rom.banks[0x3E]
+    if bank3e[0] == 0xCD:
+        jump_table = bank3e[1] | (bank3e[2] << 8)
+        if 0x4000 <= jump_table < 0x7FFE and bank3e[jump_table - 0x4000] == 0xC7:
+            offset = jump_table - 0x4000 + 1
+            hooks.append(("MainLoop", bank3e[offset] | (bank3e[offset + 1] << 8)))
+
+    analyzer = TimingAnalyzer(memory, 0x0000, call_costs=call_costs, loop_bounds=loop_bounds, default_loop_bound=default_loop_bound, no_return=(0x0000, ))
+    result = []
+    for name, entry in hooks:
+        report = analyzer.analyze(entry)
+        report["name"] = name
+        report["fits"] = report["worst"] is not None and not report["unknown_calls"] and report["worst"] <= FRAME_CYCLES
+        result.append(report)
+    return result
@@ -188,22 +188,11 @@ def formatText(s, *, center=False, ask=None):
 
 
 def tileDataToString(data, key=" 123"):
-    result = ""
-    for n in range(0, len(data), 2):
-        a = data[n]
-        b = data[n+1]
-        for m in range(8):
-            bit = 0x80 >> m
-            if (a & bit) and (b & bit):
-                result += key[3]
-            elif (b & bit):
-                result += key[2]
-            elif (a & bit):
-                result += key[1]
-            else:
-                result += key[0]
-        result += "\n"
-    return result
+    import tileCodec
+    rows = len(data) // 2
+    # Pad to whole tiles, as the data does not need to be a whole number of tiles.
+    pixels = tileCodec.decode(bytes(data) + bytes(-len(data) % 16)).reshape(-1, 8)[:rows]
+    return "".join("".join(key[c] for c in row) + "\n" for row in pixels)
 
 def createTileData(data, key=" 123"):
     result = []